@@ -16,20 +16,180 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import configparser
+import copy
 import os
 import logging
+import sys
+import threading
 
 
 logger = logging.getLogger(__name__)
 
+# Parsed configuration files, indexed by path.  Each entry is a tuple of the
+# (mtime_ns, size, inode) of the file when it was parsed and its content.
+parse_cache = {}
+parse_cache_lock = threading.Lock()
 
-def parse_config(path):
+# Paths from the global section, each entry is (key, default value).
+# Relative paths are relative to base_path.
+PATH_FIELDS = (
+    ("gpg_key_path", "secret/gpg/keys"),
+    ("gpg_keyring_path", "secret/gpg/keyrings"),
+    ("publish_path", "www"),
+    ("state_path", "state"),
+    )
+
+# Optional mirror settings, falling back to the mirror_default section.
+# Each entry is (key, type, relative to base_path).
+MIRROR_FIELDS = (
+    ("ssh_user", str, False),
+    ("ssh_key", str, True),
+    ("ssh_port", int, False),
+    ("ssh_command", str, False),
+    )
+
+# Scalar channel settings, each entry is (key, type, default value).
+CHANNEL_FIELDS = (
+    ("versionbase", int, 1),
+    ("type", str, "manual"),
+    ("fullcount", int, 0),
+    )
+
+
+def as_list(value):
+    """
+        Return a configuration value as a list, parse_config only returns
+        lists for values that contain several entries.
+    """
+
+    if isinstance(value, list):
+        return value
+
+    return [value]
+
+
+class Mirror:
+    __slots__ = ("ssh_host", "ssh_user", "ssh_key", "ssh_port",
+                 "ssh_command")
+
+
+class Channel:
+    __slots__ = ("versionbase", "type", "fullcount", "deltabase", "files")
+
+
+def parse_config(path, stat=None):
+    """
+        Parse a configuration file and return its content as a dict of
+        sections.
+
+        The result is cached until the file changes, callers always get
+        their own copy.  stat may be passed when the caller already has
+        the os.stat() result of the file.
+    """
+
+    if stat is None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {}
+
+    path = os.path.abspath(path)
+    stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    with parse_cache_lock:
+        cached = parse_cache.get(path)
+
+    if not cached or cached[0] != stamp:
+        cached = (stamp, read_config(path))
+        with parse_cache_lock:
+            parse_cache[path] = cached
+
+    return copy.deepcopy(cached[1])
+
+
+def tokenize_config(fd, path):
+    """
+        Read the sections of an INI file in a single pass.
+
+        This follows the configparser rules used by this project (no
+        interpolation, case sensitive keys, "=" or ":" delimiters, full
+        line comments, indented continuation lines and a DEFAULT section)
+        without going through its generic machinery.
+
+        Returns a dict of sections, each a dict of option to list of lines.
+        Raises configparser.Error on invalid content.
+    """
+
+    sections = {}
+    defaults = {}
+    section_name = None
+    section = None
+    option = None
+    indent_level = 0
+
+    for lineno, line in enumerate(fd, start=1):
+        value = line.strip()
+        if not value or value[0] in "#;":
+            # Blank lines are kept inside of multi-line values.
+            if not value and option:
+                section[option].append("")
+            continue
+
+        # Continuation line
+        cur_indent_level = len(line) - len(line.lstrip())
+        if option and cur_indent_level > indent_level:
+            section[option].append(value)
+            continue
+
+        indent_level = cur_indent_level
+        option = None
+
+        # Section header
+        if value[0] == "[" and value.rfind("]") > 1:
+            section_name = value[1:value.rfind("]")]
+            if section_name == "DEFAULT":
+                section = defaults
+            elif section_name in sections:
+                raise configparser.DuplicateSectionError(
+                    section_name, path, lineno)
+            else:
+                section = sections[section_name] = {}
+            continue
+
+        if section is None:
+            raise configparser.MissingSectionHeaderError(path, lineno, line)
+
+        # Option line
+        delimiter = min(index for index in (value.find("="), value.find(":"),
+                                            len(value)) if index >= 0)
+        key = value[:delimiter].rstrip()
+        if not key or delimiter == len(value):
+            error = configparser.ParsingError(path)
+            error.append(lineno, repr(line))
+            raise error
+
+        if key in section:
+            raise configparser.DuplicateOptionError(
+                section_name, key, path, lineno)
+
+        option = key
+        section[option] = [value[delimiter + 1:].strip()]
+
+    for options in sections.values():
+        for key, value in defaults.items():
+            options.setdefault(key, value)
+
+    return sections
+
+
+def read_config(path):
     config = {}
 
-    configp = configparser.ConfigParser(interpolation=None)
-    configp.optionxform = str
     try:
-        configp.read(path)
+        with open(path, "r") as fd:
+            sections = tokenize_config(fd, path)
+    except OSError:
+        return config
     except configparser.Error as e:
         logger.exception(e)
         logger.error(
@@ -37,38 +197,56 @@ def parse_config(path):
             )
         return config
 
-    for section in configp.sections():
+    for section, options in sections.items():
         config_section = {}
-        for option in configp.options(section):
-            value = configp.get(section, option)
+        for option, lines in options.items():
+            value = "\n".join(lines).rstrip()
             if ", " in value:
                 value = [entry.strip("\"").strip()
                          for entry in value.split(", ")]
             else:
                 value = value.strip("\"").strip()
-            config_section[option] = value
-        config[section] = config_section
+            # Interned keys match the identical key literals used by
+            # load_config and the generators on identity alone.
+            config_section[sys.intern(option)] = value
+        config[sys.intern(section)] = config_section
 
     return config
 
 
 class Config:
-    def __init__(self, path=None):
+    def __init__(self, path=None, config=None):
+        # An already parsed configuration (as returned by parse_config) may
+        # be passed instead of a path, to avoid reading the file again.
+        if config is not None:
+            self.load_config(path, copy.deepcopy(config))
+            return
+
+        stat = None
         if not path:
             path = "%s/etc/config" % os.environ.get("SYSTEM_IMAGE_ROOT",
                                                     os.getcwd())
-            if not os.path.exists(path):
+            # The stat result is passed on so that the file is only
+            # looked up once.
+            try:
+                stat = os.stat(path)
+            except OSError:
                 path = os.path.realpath(os.path.join(os.path.dirname(__file__),
                                                      "../../etc/config"))
 
-        self.load_config(path)
+        self.load_config(path, stat=stat)
 
-    def load_config(self, path):
-        if not os.path.exists(path):
-            raise Exception("Configuration file doesn't exist: %s" % path)
+    def load_config(self, path, config=None, stat=None):
+        if config is None:
+            if stat is None:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    raise Exception("Configuration file doesn't exist: %s" %
+                                    path)
 
-        # Read the config
-        config = parse_config(path)
+            # Read the config
+            config = parse_config(path, stat)
 
         if 'global' not in config:
             config['global'] = {}
@@ -77,28 +255,17 @@ class Config:
         self.base_path = config['global'].get(
             "base_path", os.environ.get("SYSTEM_IMAGE_ROOT", os.getcwd()))
 
-        self.gpg_key_path = config['global'].get(
-            "gpg_key_path", os.path.join(self.base_path,
-                                         "secret", "gpg", "keys"))
-        if not self.gpg_key_path.startswith("/"):
-            self.gpg_key_path = os.path.join(self.base_path, self.gpg_key_path)
-
-        self.gpg_keyring_path = config['global'].get(
-            "gpg_keyring_path", os.path.join(self.base_path,
-                                             "secret", "gpg", "keyrings"))
-        if not self.gpg_keyring_path.startswith("/"):
-            self.gpg_keyring_path = os.path.join(self.base_path,
-                                                 self.gpg_keyring_path)
-
-        self.publish_path = config['global'].get(
-            "publish_path", os.path.join(self.base_path, "www"))
-        if not self.publish_path.startswith("/"):
-            self.publish_path = os.path.join(self.base_path, self.publish_path)
-
-        self.state_path = config['global'].get(
-            "state_path", os.path.join(self.base_path, "state"))
-        if not self.state_path.startswith("/"):
-            self.state_path = os.path.join(self.base_path, self.state_path)
+        for key, default in PATH_FIELDS:
+            value = config['global'].get(key, default)
+            if not value.startswith("/"):
+                value = os.path.join(self.base_path, value)
+            setattr(self, key, value)
+
+        # Optional location for the temporary files of the generators,
+        # typically a faster filesystem than the default one.
+        self.temp_path = config['global'].get("temp_path")
+        if self.temp_path and not self.temp_path.startswith("/"):
+            self.temp_path = os.path.join(self.base_path, self.temp_path)
 
         # Export some more keys as-is
         for key in ("public_fqdn", "public_http_port", "public_https_port"):
@@ -109,103 +276,94 @@ class Config:
 
         # Parse the mirror configuration
         self.mirrors = {}
-        if "mirrors" in config['global']:
-            if not isinstance(config['global']['mirrors'], list):
-                config['global']['mirrors'] = [config['global']['mirrors']]
-
-            if len(config['global']['mirrors']) != 0:
-                if "mirror_default" not in config:
-                    raise KeyError("Missing mirror_default section.")
-
-                for key in ("ssh_user", "ssh_key", "ssh_port", "ssh_command"):
-                    if key not in config['mirror_default']:
-                        raise KeyError("Missing key in mirror_default: %s" %
-                                       key)
-
-                for entry in config['global']['mirrors']:
-                    dict_entry = "mirror_%s" % entry
-                    if dict_entry not in config:
-                        raise KeyError("Missing mirror section: %s" %
-                                       dict_entry)
-
-                    mirror = type("Mirror", (object,), {})
-
-                    if "ssh_host" not in config[dict_entry]:
-                        raise KeyError("Missing key in %s: ssh_host" %
-                                       dict_entry)
-                    else:
-                        mirror.ssh_host = config[dict_entry]['ssh_host']
-
-                    mirror.ssh_user = config[dict_entry].get(
-                        "ssh_user", config['mirror_default']['ssh_user'])
-                    mirror.ssh_key = config[dict_entry].get(
-                        "ssh_key", config['mirror_default']['ssh_key'])
-                    if not mirror.ssh_key.startswith("/"):
-                        mirror.ssh_key = os.path.join(self.base_path,
-                                                      mirror.ssh_key)
-                    mirror.ssh_port = int(config[dict_entry].get(
-                        "ssh_port", config['mirror_default']['ssh_port']))
-                    mirror.ssh_command = config[dict_entry].get(
-                        "ssh_command", config['mirror_default']['ssh_command'])
-
-                    self.mirrors[entry] = mirror
+        mirrors = as_list(config['global'].get("mirrors", []))
+        if mirrors:
+            if "mirror_default" not in config:
+                raise KeyError("Missing mirror_default section.")
+
+            mirror_default = config['mirror_default']
+            for key, value_type, is_path in MIRROR_FIELDS:
+                if key not in mirror_default:
+                    raise KeyError("Missing key in mirror_default: %s" % key)
+
+            for entry in mirrors:
+                dict_entry = "mirror_%s" % entry
+                if dict_entry not in config:
+                    raise KeyError("Missing mirror section: %s" % dict_entry)
+
+                self.mirrors[entry] = self.load_mirror(
+                    dict_entry, config[dict_entry], mirror_default)
 
         # Parse the channel configuration
         self.channels = {}
-        if "channels" in config['global']:
-            if not isinstance(config['global']['channels'], list):
-                config['global']['channels'] = \
-                    [config['global']['channels']]
-
-            if len(config['global']['channels']) != 0:
-                for entry in config['global']['channels']:
-                    dict_entry = "channel_%s" % entry
-                    if dict_entry not in config:
-                        raise KeyError("Missing channel section: %s" %
-                                       dict_entry)
-
-                    channel = type("Channel", (object,), {})
-
-                    channel.versionbase = int(config[dict_entry].get(
-                        'versionbase', 1))
-
-                    channel.type = config[dict_entry].get(
-                        "type", "manual")
-
-                    channel.fullcount = int(config[dict_entry].get(
-                        "fullcount", 0))
-
-                    channel.deltabase = [entry]
-                    if "deltabase" in config[dict_entry]:
-                        if isinstance(config[dict_entry]['deltabase'],
-                                      list):
-                            channel.deltabase = \
-                                config[dict_entry]['deltabase']
-                        else:
-                            channel.deltabase = \
-                                [config[dict_entry]['deltabase']]
-
-                    # Parse the file list
-                    files = config[dict_entry].get("files", [])
-                    if isinstance(files, str):
-                        files = [files]
-
-                    channel.files = []
-                    for file_entry in files:
-                        if "file_%s" % file_entry not in config[dict_entry]:
-                            raise KeyError("Missing file entry: %s" %
-                                           "file_%s" % file_entry)
-
-                        fields = (config[dict_entry]
-                                  ['file_%s' % file_entry].split(";"))
-
-                        file_dict = {}
-                        file_dict['name'] = file_entry
-                        file_dict['generator'] = fields[0]
-                        file_dict['arguments'] = []
-                        if len(fields) > 1:
-                            file_dict['arguments'] = fields[1:]
-
-                        channel.files.append(file_dict)
-
-                    self.channels[entry] = channel
+        for entry in as_list(config['global'].get("channels", [])):
+            dict_entry = "channel_%s" % entry
+            if dict_entry not in config:
+                raise KeyError("Missing channel section: %s" % dict_entry)
+
+            self.channels[entry] = self.load_channel(entry,
+                                                     config[dict_entry])
+
+    def load_mirror(self, name, section, mirror_default):
+        """
+            Build a mirror from its configuration section, falling back to
+            the mirror_default section for the optional keys.
+        """
+
+        mirror = Mirror()
+
+        if "ssh_host" not in section:
+            raise KeyError("Missing key in %s: ssh_host" % name)
+        else:
+            mirror.ssh_host = section['ssh_host']
+
+        base_path = self.base_path
+        join = os.path.join
+        for key, value_type, is_path in MIRROR_FIELDS:
+            value = section.get(key, mirror_default[key])
+            if is_path and not value.startswith("/"):
+                value = join(base_path, value)
+            setattr(mirror, key, value_type(value))
+
+        return mirror
+
+    def load_channel(self, name, section):
+        """
+            Build a channel from its configuration section.
+        """
+
+        channel = Channel()
+
+        for key, value_type, default in CHANNEL_FIELDS:
+            setattr(channel, key, value_type(section.get(key, default)))
+
+        channel.deltabase = as_list(section.get("deltabase", name))
+
+        # Parse the file list
+        channel.files = []
+        for file_entry in as_list(section.get("files", [])):
+            key = "file_%s" % file_entry
+            if key not in section:
+                raise KeyError("Missing file entry: %s" % key)
+
+            generator, *arguments = section[key].split(";")
+            channel.files.append({'name': file_entry,
+                                  'generator': generator,
+                                  'arguments': arguments})
+
+        return channel
+
+
+def get_config(path):
+    """
+        Return a Config for the configuration file at path, built from
+        its cached parse (see parse_config) so that the file only gets
+        read again once it changes.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Exception("Configuration file doesn't exist: %s" % path)
+
+    return Config(path, config=parse_config(path, stat))
@@ -15,13 +15,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os
-import sys
+import pickle
 import tarfile
+import threading
 import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
+from systemimage.helpers import READ_SIZE
+
+# Bump whenever the format of the scan_content result changes, so that
+# stale cache entries get ignored.
+SCAN_CACHE_VERSION = 8
+
+# Details of each member kept in the scan cache, enough to find and extract
+# it without walking the image.  The complete member can then be read back
+# from its header with ImageDiff.read_member().
+MEMBER_FIELDS = ("name", "offset", "offset_data", "size", "type", "linkname")
+
+# Once a scan cache grows past this size, its least recently used entries
+# get removed by prune_scan_cache().
+SCAN_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Below this number of files to compare, a thread pool costs more than it
+# saves.
+PARALLEL_COMPARE_MIN = 8
+
 
 def compare_files(fd_source, fd_target):
     """
@@ -38,72 +60,245 @@ def compare_files(fd_source, fd_target):
     if not fd_source or not fd_target:
         return False
 
-    return fd_source.read() == fd_target.read()
+    # Only equality matters, so compare the content block by block and
+    # stop at the first difference rather than hashing both files.
+    while True:
+        source_block = fd_source.read(READ_SIZE)
+        if source_block != fd_target.read(READ_SIZE):
+            return False
+
+        if not source_block:
+            return True
 
 
-# For the data portion of the set and dict contents.
+# For the data portion of the dict contents.
 FHash = namedtuple('FHash', 'mode devmajor devminor type uid gid size mtime')
-# The set contents record.
-SContent = namedtuple('SContent', 'path filetype data')
 # The dict contents record.
 DContent = namedtuple('DContent', 'filetype data')
 
 
-def list_tarfile(tarfile):
+def list_tarfile(tarfile, entries=None):
     """
         Walk through a tarfile and generate a list of the content.
 
-        Returns a tuple containing a set and a dict.
-        The set is typically used for simple diffs between tarballs.
-        The dict is used to easily grab the details of a specific entry.
+        Returns a dict mapping the path of each entry to its details,
+        along with the set of paths which are hardlinks.
+
+        Identical details are stored as a single object, shared through
+        the entries dict with other scans using it.
     """
 
-    set_content = set()
     dict_content = {}
+    hardlinks = set()
+    if entries is None:
+        entries = {}
 
     for entry in tarfile:
         if entry.isdir():
-            set_content.add(SContent(entry.path, "dir", None))
-            dict_content[entry.path] = DContent("dir", None)
+            content = DContent("dir", None)
         else:
             fhash = FHash(
-                "%s" % entry.mode,
-                "%s" % entry.devmajor,
-                "%s" % entry.devminor,
-                "%s" % entry.type.decode("utf-8"),
-                "%s" % entry.uid,
-                "%s" % entry.gid,
-                "%s" % entry.size,
-                "%s" % entry.mtime)
+                entry.mode,
+                entry.devmajor,
+                entry.devminor,
+                entry.type,
+                entry.uid,
+                entry.gid,
+                entry.size,
+                entry.mtime)
+
+            content = DContent("file", fhash)
+            if entry.islnk():
+                hardlinks.add(entry.path)
+
+        dict_content[entry.path] = entries.setdefault(content, content)
+
+    return dict_content, hardlinks
+
+
+def prune_scan_cache(cache_path, max_size=SCAN_CACHE_MAX_SIZE):
+    """
+        Remove the least recently used entries of a scan cache until its
+        total size is no more than max_size.
+    """
+
+    entries = []
+    try:
+        with os.scandir(cache_path) as scan:
+            for entry in scan:
+                # Leave the temporary files of running scans alone.
+                if not entry.name.endswith(".pickle"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
 
-            set_content.add(SContent(entry.path, "file", fhash))
-            dict_content[entry.path] = DContent("file", fhash)
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
 
-    return set_content, dict_content
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
 
 
 class ImageDiff:
     source_content = None
     target_content = None
+    source_hardlinks = None
+    target_hardlinks = None
+    source_members = None
+    target_members = None
     diff = None
-
-    def __init__(self, source, target):
+    sorted_diff = None
+
+    def __init__(self, source, target, cache_path=None,
+                 source_origin=None, target_origin=None):
+        self.source_path = source
+        self.target_path = target
+        # When cache_path is set, the content listing of each image is kept
+        # there, keyed by the path, size and mtime of the image or of its
+        # origin (e.g. the .tar.xz it was uncompressed from).
+        self.cache_path = cache_path
+        self.source_origin = source_origin or source
+        self.target_origin = target_origin or target
+        # Details shared by the scans of both images, so that unchanged
+        # entries compare by identity.
+        self.entries = {}
         self.source_file = tarfile.open(source, 'r:', encoding='utf-8')
         self.target_file = tarfile.open(target, 'r:', encoding='utf-8')
 
     def scan_content(self, image):
         """
-            Scan the content of an image and return the image tuple.
-            This also caches the content for further use.
+            Scan the content of an image and return its content dict.
+            This also caches the content, the set of hardlinks and the
+            member index for further use.
         """
         image_file = getattr(self, image + "_file", None)
         if image_file is None:
             raise KeyError("Invalid image '%s'." % image)
 
-        content = list_tarfile(image_file)
+        scan = None
+        if self.cache_path:
+            cache_file = self.scan_cache_file(getattr(self, image + "_origin"))
+            try:
+                with open(cache_file, "rb") as fd:
+                    scan = pickle.load(fd)
+                content, hardlinks, member_index = scan
+            except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+                    AttributeError, ImportError):
+                # A missing, truncated or otherwise unreadable entry is
+                # simply a cache miss.
+                scan = None
+            else:
+                # Mark the entry as recently used for prune_scan_cache().
+                try:
+                    os.utime(cache_file)
+                except OSError:
+                    pass
+
+        if scan is None:
+            content, hardlinks = list_tarfile(image_file, self.entries)
+
+            # Walking the image loaded its members, so index them while
+            # they're at hand.  Only the few details needed to find them
+            # get cached, the complete TarInfo objects are several times
+            # bigger.  Sparse members can't be extracted from those details
+            # alone, so images with any are walked again instead.
+            members = self.index_members(image)
+            member_index = None
+            if not any(member.issparse() for member in members.values()):
+                member_index = [
+                    tuple(getattr(member, field) for field in MEMBER_FIELDS)
+                    for member in members.values()]
+            scan = (content, hardlinks, member_index)
+
+            if self.cache_path:
+                # Write to a temporary file first so that concurrent runs
+                # (and scans) never load a partial entry.
+                temp_file = "%s.%s.%s" % (cache_file, os.getpid(),
+                                          threading.get_ident())
+                try:
+                    os.makedirs(self.cache_path, exist_ok=True)
+                    with open(temp_file, "wb") as fd:
+                        pickle.dump(scan, fd, pickle.HIGHEST_PROTOCOL)
+                    os.replace(temp_file, cache_file)
+                except OSError:
+                    # The cache is only an optimization: failing to fill
+                    # it (e.g. on a full disk) mustn't fail the diff.
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+
+        elif member_index is not None:
+            members = {}
+            for fields in member_index:
+                member = tarfile.TarInfo()
+                for field, value in zip(MEMBER_FIELDS, fields):
+                    setattr(member, field, value)
+                members[member.name] = member
+            setattr(self, image + "_members", members)
+
         setattr(self, image + "_content", content)
+        setattr(self, image + "_hardlinks", hardlinks)
         return content
 
+    def index_members(self, image):
+        """
+            Return a dict of the members of an image, indexed by name.
+            This also caches the index for further use, unlike
+            TarFile.getmember() which searches the member list every time.
+        """
+        members = getattr(self, image + "_members", None)
+        if members is None:
+            image_file = getattr(self, image + "_file", None)
+            if image_file is None:
+                raise KeyError("Invalid image '%s'." % image)
+
+            # Later entries for the same name win, as with getmember().
+            members = {member.name: member
+                       for member in image_file.getmembers()}
+            setattr(self, image + "_members", members)
+
+        return members
+
+    def read_member(self, image, member):
+        """
+            Return the complete member (e.g. with its ownership and
+            permissions) for a member of the index, which may only hold
+            what's needed to extract it when it comes from the scan cache.
+            Only the header of the member gets read.
+        """
+        image_file = getattr(self, image + "_file", None)
+        if image_file is None:
+            raise KeyError("Invalid image '%s'." % image)
+
+        # Reading a header moves the position of the next member, which
+        # must be left alone in case the image still gets walked.
+        offset = image_file.offset
+        try:
+            image_file.fileobj.seek(member.offset)
+            return tarfile.TarInfo.fromtarfile(image_file)
+        finally:
+            image_file.offset = offset
+
+    def scan_cache_file(self, path):
+        """
+            Return the path to the scan cache entry for a given image.
+        """
+        stat = os.stat(path)
+        key = "%s\0%s\0%s\0%s" % (SCAN_CACHE_VERSION, os.path.realpath(path),
+                                  stat.st_size, stat.st_mtime_ns)
+
+        return os.path.join(self.cache_path, "%s.pickle" %
+                            hashlib.sha1(key.encode("utf-8")).hexdigest())
+
     def compare_images(self):
         """
             Compare the file listing of two images and return a set.
@@ -117,94 +312,169 @@ class ImageDiff:
         if self.target_content is None:
             self.scan_content("target")
 
-        source_set, source_dict = self.source_content
-        target_set, target_dict = self.target_content
-
-        # Find the changes in the two trees
-        changes = set()
-        for change in source_set.symmetric_difference(target_set):
-            if change.path not in source_dict:
-                change_type = "add"
-            elif change.path not in target_dict:
-                change_type = "del"
-            else:
-                change_type = "mod"
-            changes.add((change.path, change_type))
-
-        # Do a second pass through the source and target sets, looking for any
-        # hardlinks that point to a file that's being modified in the target.
-        # These links must get also get modified or they'll end up pointing to
-        # the old inode.
-        for no_change in source_set.intersection(target_set):
-            if no_change.filetype == "file" and no_change.data.type == "1":
-                # This is a hardlink which exists in both the source and
-                # target, *and* points to the same link target (by virtue of
-                # the set intersection).
-                changes.add((no_change.path, "mod"))
+        source_dict = self.source_content
+        target_dict = self.target_content
+
+        # Find the changes in the two trees, keeping the details of the
+        # modified entries at hand for the mtime check below.
+        source_paths = source_dict.keys()
+        target_paths = target_dict.keys()
+        changes = {(path, "del") for path in source_paths - target_paths}
+        changes.update((path, "add") for path in target_paths - source_paths)
+
+        modified = [(path, source_dict[path].data, target_dict[path].data)
+                    for path in source_paths & target_paths
+                    if source_dict[path] != target_dict[path]]
+
+        # Hardlinks which exist in both the source and target, *and* point
+        # to the same link target.  Hardlinks pointing to a file that's
+        # being modified in the target must also get modified or they'll
+        # end up pointing to the old inode.  Only the (few) hardlinks need
+        # to be looked at, rather than every unchanged entry.
+        modified.extend(
+            (path, source_dict[path].data, target_dict[path].data)
+            for path in self.source_hardlinks & self.target_hardlinks
+            if source_dict[path] == target_dict[path])
+        changes.update((path, "mod") for path, _, _ in modified)
 
         # Ignore files that only vary in mtime
-        # (separate loop to run after de-dupe)
-        for change in sorted(changes):
-            change_path, change_type = change
-            if change_type == "mod":
-                fstat_source = source_dict[change_path].data
-                fstat_target = target_dict[change_path].data
-
-                # Skip differences between directories and files
-                if not fstat_source or not fstat_target:  # pragma: no cover
+        source_members = self.index_members("source")
+        target_members = self.index_members("target")
+        candidates = []
+        unchanged = set()
+        for change_path, fstat_source, fstat_target in modified:
+            change = (change_path, "mod")
+
+            # Skip differences between directories and files
+            if not fstat_source or not fstat_target:  # pragma: no cover
+                continue
+
+            # Deal with switched hardlinks.
+            #
+            # stgraber says on 2015-05-27: this was trying to solve the
+            # case where the hardlink target would be placed *after* the
+            # hardlink in the tar archive, leading to a hardlink being
+            # created to the wrong file at unpack.  barry thinks: ???
+            if (
+                    fstat_source.mode == fstat_target.mode
+                    and fstat_source.devmajor == fstat_target.devmajor
+                    and fstat_source.devminor == fstat_target.devminor
+                    and (fstat_source.type == tarfile.LNKTYPE or
+                         fstat_target.type == tarfile.LNKTYPE)
+                    and fstat_source.uid == fstat_target.uid
+                    and fstat_source.gid == fstat_target.gid
+                    # size is ignored since it is always 0 for hardlinks.
+                    and fstat_source.mtime == fstat_target.mtime):
+                source_file = source_members[change_path]
+                target_file = target_members[change_path]
+                candidates.append((change, source_file, target_file))
+                continue
+
+            # Deal with regular files.  Compare all attributes of the file
+            # except the mtime.
+            if fstat_source[0:7] == fstat_target[0:7]:
+                # Symlinks that point to the same file in both the source
+                # and target can be ignored, however *hardlinks* cannot,
+                # since the inode they point to may change out from
+                # underneath them.
+                if fstat_source.type == tarfile.SYMTYPE:
+                    if (source_members[change_path].linkpath ==
+                            target_members[change_path].linkpath):
+                        unchanged.add(change)
                     continue
 
-                # Deal with switched hardlinks.
-                #
-                # stgraber says on 2015-05-27: this was trying to solve the
-                # case where the hardlink target would be placed *after* the
-                # hardlink in the tar archive, leading to a hardlink being
-                # created to the wrong file at unpack.  barry thinks: ???
-                if (
-                        fstat_source.mode == fstat_target.mode
-                        and fstat_source.devmajor == fstat_target.devmajor
-                        and fstat_source.devminor == fstat_target.devminor
-                        # "1" is the LNKTYPE, i.e. hard link.
-                        and (fstat_source.type == "1" or
-                             fstat_target.type == "1")
-                        and fstat_source.uid == fstat_target.uid
-                        and fstat_source.gid == fstat_target.gid
-                        # size is ignored since it is always 0 for hardlinks.
-                        and fstat_source.mtime == fstat_target.mtime):
-                    source_file = self.source_file.getmember(change_path)
-                    target_file = self.target_file.getmember(change_path)
-                    if compare_files(
-                            self.source_file.extractfile(change_path),
-                            self.target_file.extractfile(change_path)):
-                        changes.remove(change)
-                        continue
-
-                # Deal with regular files.  Compare all attributes of the file
-                # except the mtime.
-                if fstat_source[0:7] == fstat_target[0:7]:
-                    source_file = self.source_file.getmember(change_path)
-                    target_file = self.target_file.getmember(change_path)
-                    # Symlinks that point to the same file in both the source
-                    # and target can be ignored, however *hardlinks* cannot,
-                    # since the inode they point to may change out from
-                    # underneath them.
-                    if (
-                            source_file.type == "2"
-                            and target_file.type == "2"
-                            and source_file.linkpath == target_file.linkpath):
-                        changes.remove(change)
-                        continue
-
-                    if (source_file.isfile() and target_file.isfile()
-                            and compare_files(
-                                self.source_file.extractfile(change_path),
-                                self.target_file.extractfile(change_path))):
-                        changes.remove(change)
-                        continue
+                source_file = source_members[change_path]
+                target_file = target_members[change_path]
+                if source_file.isfile() and target_file.isfile():
+                    candidates.append((change, source_file, target_file))
+                    continue
+
+        # Drop the changes whose content turns out to be identical
+        unchanged.update(self.compare_members(candidates))
+        changes = changes - unchanged
 
         self.diff = changes
+        self.sorted_diff = sorted(changes)
         return changes
 
+    def compare_members(self, candidates):
+        """
+            Compare the content of a list of (key, source member,
+            target member) tuples and return the keys of those whose
+            content matches.
+
+            Larger lists are compared in parallel.
+        """
+
+        source_members = self.index_members("source")
+        target_members = self.index_members("target")
+        candidates = [(key,
+                       self.resolve_member(source_members, source_member),
+                       self.resolve_member(target_members, target_member))
+                      for key, source_member, target_member in candidates]
+
+        if len(candidates) < PARALLEL_COMPARE_MIN:
+            return [key for key, source_member, target_member in candidates
+                    if compare_files(
+                        self.source_file.extractfile(source_member),
+                        self.target_file.extractfile(target_member))]
+
+        # TarFile objects aren't thread-safe, so each worker reads through
+        # its own handles on the images.
+        local = threading.local()
+        handles = []
+
+        def compare(candidate):
+            key, source_member, target_member = candidate
+            if not hasattr(local, "images"):
+                local.images = (
+                    tarfile.open(self.source_path, 'r:', encoding='utf-8'),
+                    tarfile.open(self.target_path, 'r:', encoding='utf-8'))
+                handles.extend(local.images)
+            source_file, target_file = local.images
+
+            # Hardlinks that couldn't be resolved must be looked up in the
+            # worker's own member list, so pass them by name.
+            if source_member.islnk():
+                source_member = source_member.name
+            if target_member.islnk():
+                target_member = target_member.name
+
+            return key, compare_files(source_file.extractfile(source_member),
+                                      target_file.extractfile(target_member))
+
+        try:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                return [key for key, match in executor.map(compare, candidates)
+                        if match]
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def resolve_member(self, members, member):
+        """
+            Return the regular file member a hardlink points to, using
+            the member index rather than having tarfile scan its member
+            list on every extraction.
+
+            Any other member, or a hardlink whose target isn't a regular
+            file stored before it in the archive, is returned unchanged.
+        """
+
+        if not member.islnk():
+            return member
+
+        # The index is keyed by the raw member names, which the link names
+        # of an archive normally match (both keep any "./" prefix).
+        target = members.get(member.linkname)
+        if target is None:
+            target = members.get(os.path.normpath(member.linkname))
+        if target is None or not target.isfile() or \
+                target.offset >= member.offset:
+            return member
+
+        return target
+
     def print_changes(self):
         """
             Simply print the list of changes.
@@ -213,7 +483,7 @@ class ImageDiff:
         if not self.diff:
             self.compare_images()
 
-        for change in sorted(self.diff):
+        for change in self.sorted_diff:
             print(" - %s (%s)" % (change[0], change[1]))
 
     def generate_diff_tarball(self, path):
@@ -226,37 +496,40 @@ class ImageDiff:
         if not self.diff:
             self.compare_images()
 
-        output = tarfile.open(path, 'w:', format=tarfile.GNU_FORMAT)
+        # Copy the member content in larger chunks than tarfile's 16kB.
+        output = tarfile.open(path, 'w:', format=tarfile.GNU_FORMAT,
+                              copybufsize=READ_SIZE)
 
         # List both deleted files and modified files in the removal list
         # that's needed to allow file type change (e.g. directory to symlink)
-        removed_files_list = sorted([entry[0] for entry in self.diff
-                                     if entry[1] in ("del", "mod")])
-
-        removed_files = "%s\n" % "\n".join(removed_files_list)
+        removed_files_list = [entry[0] for entry in self.sorted_diff
+                              if entry[1] in ("del", "mod")]
 
-        if sys.version_info.major > 2:  # pragma: no cover
-            removed_files = removed_files.encode("utf-8")
+        removed_files = ("%s\n" % "\n".join(removed_files_list)).encode(
+            "utf-8")
 
         removals = tarfile.TarInfo()
         removals.name = "removed"
         removals.size = len(removed_files)
-        removals.mtime = int(time.strftime("%s", time.localtime()))
+        removals.mtime = int(time.time())
         removals.uname = "root"
         removals.gname = "root"
 
         output.addfile(removals, BytesIO(removed_files))
 
         # Copy all the added and modified
-        added = []
-        for name, action in sorted(self.diff):
+        target_members = self.index_members("target")
+        changed_paths = {name for name, action in self.diff
+                         if action in ("add", "mod")}
+        added = set()
+        for name, action in self.sorted_diff:
             if action == 'del':
                 continue
 
             if name in added:
                 continue
 
-            newfile = self.target_file.getmember(name)
+            newfile = self.read_member("target", target_members[name])
             if newfile.islnk():
                 if newfile.linkname.startswith("system/"):
                     targetfile_path = newfile.linkname
@@ -264,19 +537,19 @@ class ImageDiff:
                     targetfile_path = os.path.normpath(os.path.join(
                         os.path.dirname(newfile.name), newfile.linkname))
 
-                targetfile = self.target_file.getmember(targetfile_path)
+                targetfile = self.read_member("target",
+                                              target_members[targetfile_path])
 
-                if ((targetfile_path, 'add') in self.diff or
-                        (targetfile_path, 'mod') in self.diff) and \
+                if targetfile_path in changed_paths and \
                         targetfile_path not in added:
                     fileptr = self.target_file.extractfile(targetfile)
                     output.addfile(targetfile, fileptr)
-                    added.append(targetfile.name)
+                    added.add(targetfile.name)
 
             fileptr = None
             if newfile.isfile():
-                fileptr = self.target_file.extractfile(name)
+                fileptr = self.target_file.extractfile(newfile)
             output.addfile(newfile, fileobj=fileptr)
-            added.append(newfile.name)
+            added.add(newfile.name)
 
         output.close()
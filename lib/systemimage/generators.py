@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
 import json
 import logging
 import os
@@ -22,11 +23,14 @@ import shutil
 import socket
 import tarfile
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib.request import urlopen, urlretrieve, build_opener, install_opener
 
 from systemimage import diff, gpg, tools, tree
+from systemimage.helpers import file_digest
 
 # Global
 CACHE = {}
@@ -36,27 +40,203 @@ install_opener(OPENER)
 
 logger = logging.getLogger(__name__)
 
+# Architecture of the cdimage files used for each device by the
+# cdimage-ubuntu, cdimage-custom and cdimage-device-raw generators.
+# Devices that aren't listed use armhf.
+UBUNTU_ARCHES = {
+    "generic_x86": "i386",
+    "generic_i386": "i386",
+    "generic_amd64": "amd64",
+    "azure_amd64": "amd64",
+    "plano": "amd64",
+    "generic_arm64": "arm64",
+    "frieza_arm64": "arm64",
+}
+
+CUSTOM_ARCHES = {
+    "generic_x86": "i386",
+    "generic_i386": "i386",
+    "generic_amd64": "amd64",
+    "generic_arm64": "arm64",
+    "frieza_arm64": "arm64",
+}
+
+DEVICE_RAW_ARCHES = {
+    "generic_x86": "i386",
+    "generic_i386": "i386",
+    "generic_amd64": "amd64",
+    "azure_amd64": "amd64.azure",
+    "plano": "amd64.plano",
+    "raspi2_armhf": "armhf.raspi2",
+    "generic_arm64": "arm64",
+}
+
+# Extra entries (name, member_type, mode, linkname) added to Android based
+# rootfs
+ANDROID_ENTRIES = (
+    [("system/android", tarfile.DIRTYPE, 0o755, None)] +
+    [("system/%s" % partition, tarfile.SYMTYPE, 0o755,
+      "/android/%s" % partition)
+     for partition in ("cache", "data", "factory", "firmware", "persist",
+                       "system", "odm")] +
+    [("system/vendor", tarfile.SYMTYPE, 0o755, "/android/system/vendor")])
+
+# Extra entries (name, member_type, mode, linkname) added to every rootfs
+ROOTFS_ENTRIES = [
+    ("system/etc/mtab", tarfile.SYMTYPE, 0o444, "/proc/mounts"),
+    ("system/lib/modules", tarfile.DIRTYPE, 0o755, None),
+]
+
 
 class VersionError(Exception):
     """Raised when the monitor version is invalid"""
 
 
 def list_versions(cdimage_path):
-    versions = sorted([version for version in os.listdir(cdimage_path)
-                      if version not in ("pending", "current")],
-                      reverse=True)
+    # Only directories can hold a version, scandir tells them apart
+    # without an extra stat for each entry.
+    with os.scandir(cdimage_path) as entries:
+        versions = sorted([entry.name for entry in entries
+                           if entry.name not in ("pending", "current")
+                           and entry.is_dir()],
+                          reverse=True)
     logger.debug("Versions detected: %s" % versions)
     return versions
 
 
+def read_sha256sums(path):
+    """
+        Parse a SHA256SUMS file and return a dict mapping each file name
+        to its checksum.
+        The result is cached until the file changes.
+    """
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = CACHE.get("sha256sums_%s" % path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    checksums = {}
+    with open(path, "r") as fd:
+        for line in fd:
+            fields = line.strip().split(None, 1)
+            if len(fields) != 2:
+                continue
+
+            checksum, filename = fields
+            # Binary mode entries are prefixed with a '*'
+            if filename.startswith("*"):
+                filename = filename[1:]
+            checksums[filename] = checksum
+
+    CACHE["sha256sums_%s" % path] = (stamp, checksums)
+    return checksums
+
+
+def read_metadata(path):
+    """
+        Load a json metadata file, returning an empty dict if it doesn't
+        exist.
+        The result is cached until the file changes, so it must not be
+        modified.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = CACHE.get("metadata_%s" % path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with open(path, "r") as fd:
+        metadata = json.loads(fd.read())
+
+    CACHE["metadata_%s" % path] = (stamp, metadata)
+    return metadata
+
+
+def reuse_pool_file(path, version_detail, environment):
+    """
+        Return an existing pool file (path), recording its version_detail.
+        The one from its metadata wins over the passed one in case the
+        file was copied from elsewhere.
+    """
+    metadata = read_metadata(path.replace(".tar.xz", ".json"))
+    environment['version_detail'].append(
+        metadata.get("version_detail", version_detail))
+    return path
+
+
+def write_metadata(conf, path, metadata):
+    """
+        Write the json metadata file of a pool file (path) and sign it.
+    """
+    json_path = path.replace(".tar.xz", ".json")
+
+    # Write to a new file and move it in place so that an interrupted
+    # run never leaves a truncated metadata file behind.  The new file is
+    # unique to this writer, so that concurrent runs don't clobber it.
+    new_path = "%s.%s.%s" % (json_path, os.getpid(), threading.get_ident())
+    with open(new_path, "w") as fd:
+        fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
+                                     indent=4, separators=(",", ": ")))
+    os.replace(new_path, json_path)
+
+    gpg.sign_file(conf, "image-signing", json_path)
+
+
+def pool_path(conf, filename):
+    """
+        Return the real path of a file in the pool.
+        The pool directory is only resolved once, as opposed to resolving
+        every path in it.
+    """
+    pool = CACHE.get("pool_%s" % conf.publish_path)
+    if pool is None:
+        pool = os.path.realpath(os.path.join(conf.publish_path, "pool"))
+        CACHE["pool_%s" % conf.publish_path] = pool
+
+    return os.path.join(pool, filename)
+
+
+def make_temp_dir(conf):
+    """
+        Create a temporary directory for a generator, in the configured
+        temp_path if any.
+    """
+    if conf.temp_path:
+        os.makedirs(conf.temp_path, exist_ok=True)
+
+    return tempfile.mkdtemp(dir=conf.temp_path)
+
+
 def root_ownership(tarinfo):
     tarinfo.mode = 0o644
-    tarinfo.mtime = int(time.strftime("%s", time.localtime()))
+    tarinfo.mtime = int(time.time())
     tarinfo.uname = "root"
     tarinfo.gname = "root"
     return tarinfo
 
 
+def make_tarinfo(name, member_type, mode, mtime, linkname=None):
+    """
+        Returns a root owned TarInfo for a directory or symlink that gets
+        added to a generated tarball.
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = member_type
+    tarinfo.mode = mode
+    tarinfo.mtime = mtime
+    tarinfo.uname = "root"
+    tarinfo.gname = "root"
+    if linkname:
+        tarinfo.linkname = linkname
+    return tarinfo
+
+
 def unpack_arguments(arguments):
     """
         Takes a string representing comma separate key=value options and
@@ -80,8 +260,8 @@ def generate_delta(conf, source_path, target_path):
         The path to the pool file is then returned and <path>.asc is also
         generated using the default signing key.
     """
-    source_filename = source_path.split("/")[-1].replace(".tar.xz", "")
-    target_filename = target_path.split("/")[-1].replace(".tar.xz", "")
+    source_filename = os.path.basename(source_path).replace(".tar.xz", "")
+    target_filename = os.path.basename(target_path).replace(".tar.xz", "")
 
     # FIXME: This is a bit of an hack, it'd be better not to have to hardcode
     #        that kind of stuff...
@@ -99,9 +279,8 @@ def generate_delta(conf, source_path, target_path):
         return target_path
 
     # Now for everything else
-    path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                         "%s.delta-%s.tar.xz" %
-                                         (target_filename, source_filename)))
+    path = pool_path(conf, "%s.delta-%s.tar.xz" % (target_filename,
+                                                   source_filename))
     logger.debug("Path generated: %s" % path)
 
     # Return pre-existing entries
@@ -109,18 +288,34 @@ def generate_delta(conf, source_path, target_path):
         return path
 
     # Create the pool if it doesn't exist
-    if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-        os.makedirs(os.path.join(conf.publish_path, "pool"))
+    os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
     # Generate the diff
-    tempdir = tempfile.mkdtemp()
-    tools.xz_uncompress(source_path, os.path.join(tempdir, "source.tar"))
-    tools.xz_uncompress(target_path, os.path.join(tempdir, "target.tar"))
-
+    tempdir = make_temp_dir(conf)
+    # Both images are independent, so uncompress them side by side.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        uncompressed = [executor.submit(tools.xz_uncompress, image_path,
+                                        os.path.join(tempdir, filename))
+                        for image_path, filename in
+                        ((source_path, "source.tar"),
+                         (target_path, "target.tar"))]
+    for future in uncompressed:
+        future.result()
+
+    # The same images get diffed against many others, so keep their
+    # content listing around.
+    cache_path = os.path.join(conf.state_path, "scan-cache")
     imagediff = diff.ImageDiff(os.path.join(tempdir, "source.tar"),
-                               os.path.join(tempdir, "target.tar"))
+                               os.path.join(tempdir, "target.tar"),
+                               cache_path=cache_path,
+                               source_origin=source_path,
+                               target_origin=target_path)
 
     imagediff.generate_diff_tarball(os.path.join(tempdir, "output.tar"))
+
+    # Entries of expired images are never used again, drop the oldest
+    # ones once the cache gets too big.
+    diff.prune_scan_cache(cache_path)
     tools.xz_compress(os.path.join(tempdir, "output.tar"), path)
     shutil.rmtree(tempdir)
 
@@ -130,21 +325,12 @@ def generate_delta(conf, source_path, target_path):
     # Generate the metadata file
     metadata = {}
     metadata['generator'] = "delta"
-    metadata['source'] = {}
-    metadata['target'] = {}
+    metadata['source'] = read_metadata(source_path.replace(".tar.xz",
+                                                           ".json"))
+    metadata['target'] = read_metadata(target_path.replace(".tar.xz",
+                                                           ".json"))
 
-    if os.path.exists(source_path.replace(".tar.xz", ".json")):
-        with open(source_path.replace(".tar.xz", ".json"), "r") as fd:
-            metadata['source'] = json.loads(fd.read())
-
-    if os.path.exists(target_path.replace(".tar.xz", ".json")):
-        with open(target_path.replace(".tar.xz", ".json"), "r") as fd:
-            metadata['target'] = json.loads(fd.read())
-
-    with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-        fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                     indent=4, separators=(",", ": ")))
-    gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
+    write_metadata(conf, path, metadata)
 
     return path
 
@@ -156,43 +342,32 @@ def generate_file(conf, generator, arguments, environment):
         before returning the path.
     """
 
-    if generator == "version":
-        path = generate_file_version(conf, arguments, environment)
-    elif generator == "cdimage-ubuntu":
-        path = generate_file_cdimage_ubuntu(conf, arguments, environment)
-    elif generator == "cdimage-custom":
-        path = generate_file_cdimage_custom(conf, arguments, environment)
-    elif generator == "cdimage-device-raw":
-        path = generate_file_cdimage_device_raw(conf, arguments, environment)
-    elif generator == "http":
-        path = generate_file_http(conf, arguments, environment)
-    elif generator == "http-cdimage":
-        path = generate_file_http_livecd_rootfs(conf, arguments, environment)
-    elif generator == "keyring":
-        path = generate_file_keyring(conf, arguments, environment)
-    elif generator == "system-image":
-        path = generate_file_system_image(conf, arguments, environment)
-    elif generator == "remote-system-image":
-        path = generate_file_remote_system_image(conf, arguments, environment)
-    else:
+    if generator not in GENERATORS:
         raise Exception("Invalid generator: %s" % generator)
 
-    return path
+    return GENERATORS[generator](conf, arguments, environment)
 
 
 def get_monitor_version(url):
     """
         Retrieve the version number given at URL
     """
+    # A version number is only a few bytes, so anything bigger than 4kB is
+    # invalid and there's no need to read past that.
     try:
-        version = urlopen(url, timeout=5).read().decode("utf-8").strip()
+        version = urlopen(url, timeout=5).read(4097)
     except (socket.timeout, IOError) as e:
         logger.exception(e)
         logger.error("Failed to download %s", url)
         raise e
 
+    if len(version) > 4096:
+        logger.error("Version number at %s is too long", url)
+        raise VersionError()
+    version = version.decode("utf-8").strip()
+
     # Validate the version number
-    if not version or len(version.split("\n")) > 1:
+    if not version or "\n" in version:
         logger.error("Invalid or missing version number %s", version)
         raise VersionError()
 
@@ -238,50 +413,26 @@ def generate_file_http_livecd_rootfs(conf, arguments, environment):
                                     version)
 
         # FIXME: can be dropped once all the non-hased tarballs are gone
-        old_path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                                 "%s-%s.tar.xz" %
-                                                 (options.get("name",
-                                                              "http-cdimage"),
-                                                  version)))
+        old_path = pool_path(conf, "%s-%s.tar.xz" %
+                             (options.get("name", "http-cdimage"), version))
         logger.debug("Path generated: %s" % old_path)
 
         if os.path.exists(old_path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(old_path.replace(".tar.xz", ".json")):
-                with open(old_path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return old_path
+            return reuse_pool_file(old_path, version_detail, environment)
 
         # Build the path, hasing together the URL and version
         hash_string = "%s:%s" % (url, version)
         global_hash = sha256(hash_string.encode("utf-8")).hexdigest()
-        path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                             "%s-%s.tar.xz" %
-                                             (options.get("name",
-                                                          "http-cdimage"),
-                                              global_hash)))
+        path = pool_path(conf, "%s-%s.tar.xz" %
+                         (options.get("name", "http-cdimage"), global_hash))
         logger.debug("Path generated: %s" % path)
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return path
+            return reuse_pool_file(path, version_detail, environment)
 
     # Grab the real thing
-    tempdir = tempfile.mkdtemp()
+    tempdir = make_temp_dir(conf)
     old_timeout = socket.getdefaulttimeout()
     # Give it 20 minutes to download, this should be plenty
     socket.setdefaulttimeout(20)
@@ -299,7 +450,7 @@ def generate_file_http_livecd_rootfs(conf, arguments, environment):
     if not version:
         # Hash the file
         with open(os.path.join(tempdir, "download"), "rb") as fd:
-            version = sha256(fd.read()).hexdigest()
+            version = file_digest(fd, "sha256").hexdigest()
 
         # Set version_detail
         version_detail = "%s=%s" % (options.get("name", "http-cdimage"),
@@ -309,141 +460,74 @@ def generate_file_http_livecd_rootfs(conf, arguments, environment):
         CACHE['http_%s' % url] = version
 
         # Build the path
-        path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                             "%s-%s.tar.xz" %
-                                             (options.get("name",
-                                                          "http-cdimage"),
-                                              version)))
+        path = pool_path(conf, "%s-%s.tar.xz" %
+                         (options.get("name", "http-cdimage"), version))
         logger.debug("Path generated: %s" % path)
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
             shutil.rmtree(tempdir)
-            return path
+            return reuse_pool_file(path, version_detail, environment)
 
-    temp_dir = tempfile.mkdtemp()
     rootfs_path = os.path.join(tempdir, "download")
 
-    # Unpack the source tarball
+    # Create the pool if it doesn't exist
+    os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
+
+    # Generate a new shifted tarball, compressing it on the fly.  The
+    # source tarball is uncompressed as it gets read, front to back.
     logger.debug("Opening tarball for processing")
-    tools.gzip_uncompress(rootfs_path, os.path.join(temp_dir,
-                                                    "source.tar"))
-
-    # Generate a new shifted tarball
-    source_tarball = tarfile.open(os.path.join(temp_dir, "source.tar"),
-                                  "r:")
-    target_tarball = tarfile.open(os.path.join(temp_dir, "target.tar"),
-                                  "w:", format=tarfile.GNU_FORMAT)
-
-    for entry in source_tarball:
-        # FIXME: Will need to be done on the real rootfs
-        # Skip some files
-        if entry.name in ("SWAP.swap", "etc/mtab"):
-            continue
+    with tarfile.open(rootfs_path, "r|gz") as source_tarball, \
+            tools.xz_compress_stream(path) as compressed:
+        target_tarball = tarfile.open(fileobj=compressed, mode="w|",
+                                      format=tarfile.GNU_FORMAT)
 
-        fileptr = None
-        if entry.isfile():
-            try:
-                fileptr = source_tarball.extractfile(entry.name)
-            except KeyError:  # pragma: no cover
-                pass
-
-        # Update hardlinks to point to the right target
-        if entry.islnk():
-            entry.linkname = "system/%s" % entry.linkname
-
-        entry.name = "system/%s" % entry.name
-        target_tarball.addfile(entry, fileobj=fileptr)
-
-    new_file = tarfile.TarInfo()
-    new_file.type = tarfile.DIRTYPE
-    new_file.name = "system/android"
-    new_file.mode = 0o755
-    new_file.mtime = int(time.strftime("%s", time.localtime()))
-    new_file.uname = "root"
-    new_file.gname = "root"
-    target_tarball.addfile(new_file)
-
-    # # Android partitions
-    for android_path in ("cache", "data", "factory", "firmware",
-                         "persist", "system", "odm"):
-        new_file = tarfile.TarInfo()
-        new_file.type = tarfile.SYMTYPE
-        new_file.name = "system/%s" % android_path
-        new_file.linkname = "/android/%s" % android_path
-        new_file.mode = 0o755
-        new_file.mtime = int(time.strftime("%s", time.localtime()))
-        new_file.uname = "root"
-        new_file.gname = "root"
-        target_tarball.addfile(new_file)
-
-    # # /vendor
-    new_file = tarfile.TarInfo()
-    new_file.type = tarfile.SYMTYPE
-    new_file.name = "system/vendor"
-    new_file.linkname = "/android/system/vendor"
-    new_file.mode = 0o755
-    new_file.mtime = int(time.strftime("%s", time.localtime()))
-    new_file.uname = "root"
-    new_file.gname = "root"
-    target_tarball.addfile(new_file)
-
-    # writable partition
-    # (/userdata for Touch, /writable for Core)
-    new_file = tarfile.TarInfo()
-    new_file.type = tarfile.DIRTYPE
-
-    if options.get("product", "touch") == "core":
-        new_file.name = "system/writable"
-    else:
-        new_file.name = "system/userdata"
-
-    new_file.mode = 0o755
-    new_file.mtime = int(time.strftime("%s", time.localtime()))
-    new_file.uname = "root"
-    new_file.gname = "root"
-    target_tarball.addfile(new_file)
-
-    # # /etc/mtab
-    new_file = tarfile.TarInfo()
-    new_file.type = tarfile.SYMTYPE
-    new_file.name = "system/etc/mtab"
-    new_file.linkname = "/proc/mounts"
-    new_file.mode = 0o444
-    new_file.mtime = int(time.strftime("%s", time.localtime()))
-    new_file.uname = "root"
-    new_file.gname = "root"
-    target_tarball.addfile(new_file)
-
-    # # /lib/modules
-    new_file = tarfile.TarInfo()
-    new_file.type = tarfile.DIRTYPE
-    new_file.name = "system/lib/modules"
-    new_file.mode = 0o755
-    new_file.mtime = int(time.strftime("%s", time.localtime()))
-    new_file.uname = "root"
-    new_file.gname = "root"
-    target_tarball.addfile(new_file)
-
-    logger.debug("Closing tarball")
-    source_tarball.close()
-    target_tarball.close()
+        for entry in source_tarball:
+            # FIXME: Will need to be done on the real rootfs
+            # Skip some files
+            if entry.name in ("SWAP.swap", "etc/mtab"):
+                continue
 
-    # Create the pool if it doesn't exist
-    if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-        os.makedirs(os.path.join(conf.publish_path, "pool"))
+            fileptr = None
+            if entry.isfile():
+                fileptr = source_tarball.extractfile(entry)
+
+            # Update hardlinks to point to the right target
+            if entry.islnk():
+                entry.linkname = f"system/{entry.linkname}"
+
+            entry.name = f"system/{entry.name}"
+            target_tarball.addfile(entry, fileobj=fileptr)
+
+            # TarFile keeps every member it reads, even in stream mode.
+            # Nothing looks back at them, so don't let them pile up.
+            source_tarball.members = []
+
+        now = int(time.time())
+
+        # # /android, Android partitions and /vendor
+        for name, member_type, mode, linkname in ANDROID_ENTRIES:
+            target_tarball.addfile(make_tarinfo(
+                name, member_type, mode, now, linkname))
 
-    # Compress the target tarball and sign it
-    tools.xz_compress(os.path.join(temp_dir, "target.tar"), path)
+        # writable partition
+        # (/userdata for Touch, /writable for Core)
+        if options.get("product", "touch") == "core":
+            writable_path = "system/writable"
+        else:
+            writable_path = "system/userdata"
+        target_tarball.addfile(make_tarinfo(
+            writable_path, tarfile.DIRTYPE, 0o755, now))
+
+        # # /etc/mtab and /lib/modules
+        for name, member_type, mode, linkname in ROOTFS_ENTRIES:
+            target_tarball.addfile(make_tarinfo(
+                name, member_type, mode, now, linkname))
+
+        logger.debug("Closing tarball")
+        target_tarball.close()
+
+    # Sign the target tarball
     gpg.sign_file(conf, "image-signing", path)
 
     # Generate the metadata file
@@ -454,13 +538,9 @@ def generate_file_http_livecd_rootfs(conf, arguments, environment):
     metadata['rootfs_path'] = rootfs_path
     metadata['url'] = url
 
-    with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-        fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                     indent=4, separators=(",", ": ")))
-    gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
+    write_metadata(conf, path, metadata)
 
     # Cleanup
-    shutil.rmtree(temp_dir)
     shutil.rmtree(tempdir)
 
     environment['version_detail'].append(version_detail)
@@ -485,14 +565,7 @@ def generate_file_cdimage_ubuntu(conf, arguments, environment):
     if len(arguments) > 2:
         options = unpack_arguments(arguments[2])
 
-    arch = "armhf"
-    if environment['device_name'] in ("generic_x86", "generic_i386"):
-        arch = "i386"
-    elif environment['device_name'] in ("generic_amd64", "azure_amd64",
-                                        "plano"):
-        arch = "amd64"
-    elif environment['device_name'] in ("generic_arm64", "frieza_arm64"):
-        arch = "arm64"
+    arch = UBUNTU_ARCHES.get(environment['device_name'], "armhf")
 
     # Check that the directory exists
     if not os.path.exists(cdimage_path):
@@ -526,14 +599,9 @@ def generate_file_cdimage_ubuntu(conf, arguments, environment):
         version_detail = "ubuntu=%s" % version
 
         # Extract the hash
-        rootfs_hash = None
-        with open(os.path.join(cdimage_path, version,
-                               "SHA256SUMS"), "r") as fd:
-            for line in fd:
-                line = line.strip()
-                if line.endswith(rootfs_path.split("/")[-1]):
-                    rootfs_hash = line.split()[0]
-                    break
+        checksums = read_sha256sums(os.path.join(cdimage_path, version,
+                                                 "SHA256SUMS"))
+        rootfs_hash = checksums.get(os.path.basename(rootfs_path))
 
         if not rootfs_hash:
             continue
@@ -545,135 +613,69 @@ def generate_file_cdimage_ubuntu(conf, arguments, environment):
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return path
-
-        temp_dir = tempfile.mkdtemp()
-
-        # Unpack the source tarball
-        logger.debug("Opening tarball for processing")
-        tools.gzip_uncompress(rootfs_path, os.path.join(temp_dir,
-                                                        "source.tar"))
-
-        # Generate a new shifted tarball
-        source_tarball = tarfile.open(os.path.join(temp_dir, "source.tar"),
-                                      "r:")
-        target_tarball = tarfile.open(os.path.join(temp_dir, "target.tar"),
-                                      "w:", format=tarfile.GNU_FORMAT)
-
-        for entry in source_tarball:
-            # FIXME: Will need to be done on the real rootfs
-            # Skip some files
-            if entry.name in ("SWAP.swap", "etc/mtab"):
-                continue
-
-            fileptr = None
-            if entry.isfile():
-                try:
-                    fileptr = source_tarball.extractfile(entry.name)
-                except KeyError:  # pragma: no cover
-                    pass
-
-            # Update hardlinks to point to the right target
-            if entry.islnk():
-                entry.linkname = "system/%s" % entry.linkname
-
-            entry.name = "system/%s" % entry.name
-            target_tarball.addfile(entry, fileobj=fileptr)
-
-        # The touch and pocket-desktop products are the same.
-        if options.get("product", "touch") in ("touch", "pd"):
-            # FIXME: Will need to be done on the real rootfs
-            # Add some symlinks and directories
-            # # /android
-            new_file = tarfile.TarInfo()
-            new_file.type = tarfile.DIRTYPE
-            new_file.name = "system/android"
-            new_file.mode = 0o755
-            new_file.mtime = int(time.strftime("%s", time.localtime()))
-            new_file.uname = "root"
-            new_file.gname = "root"
-            target_tarball.addfile(new_file)
-
-            # # Android partitions
-            for android_path in ("cache", "data", "factory", "firmware",
-                                 "persist", "system", "odm"):
-                new_file = tarfile.TarInfo()
-                new_file.type = tarfile.SYMTYPE
-                new_file.name = "system/%s" % android_path
-                new_file.linkname = "/android/%s" % android_path
-                new_file.mode = 0o755
-                new_file.mtime = int(time.strftime("%s", time.localtime()))
-                new_file.uname = "root"
-                new_file.gname = "root"
-                target_tarball.addfile(new_file)
-
-            # # /vendor
-            new_file = tarfile.TarInfo()
-            new_file.type = tarfile.SYMTYPE
-            new_file.name = "system/vendor"
-            new_file.linkname = "/android/system/vendor"
-            new_file.mode = 0o755
-            new_file.mtime = int(time.strftime("%s", time.localtime()))
-            new_file.uname = "root"
-            new_file.gname = "root"
-            target_tarball.addfile(new_file)
-
-        # writable partition
-        # (/userdata for Touch, /writable for Core)
-        new_file = tarfile.TarInfo()
-        new_file.type = tarfile.DIRTYPE
-
-        if options.get("product", "touch") == "core":
-            new_file.name = "system/writable"
-        else:
-            new_file.name = "system/userdata"
-
-        new_file.mode = 0o755
-        new_file.mtime = int(time.strftime("%s", time.localtime()))
-        new_file.uname = "root"
-        new_file.gname = "root"
-        target_tarball.addfile(new_file)
-
-        # # /etc/mtab
-        new_file = tarfile.TarInfo()
-        new_file.type = tarfile.SYMTYPE
-        new_file.name = "system/etc/mtab"
-        new_file.linkname = "/proc/mounts"
-        new_file.mode = 0o444
-        new_file.mtime = int(time.strftime("%s", time.localtime()))
-        new_file.uname = "root"
-        new_file.gname = "root"
-        target_tarball.addfile(new_file)
-
-        # # /lib/modules
-        new_file = tarfile.TarInfo()
-        new_file.type = tarfile.DIRTYPE
-        new_file.name = "system/lib/modules"
-        new_file.mode = 0o755
-        new_file.mtime = int(time.strftime("%s", time.localtime()))
-        new_file.uname = "root"
-        new_file.gname = "root"
-        target_tarball.addfile(new_file)
-
-        logger.debug("Closing tarball")
-        source_tarball.close()
-        target_tarball.close()
+            return reuse_pool_file(path, version_detail, environment)
 
         # Create the pool if it doesn't exist
-        if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-            os.makedirs(os.path.join(conf.publish_path, "pool"))
+        os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
-        # Compress the target tarball and sign it
-        tools.xz_compress(os.path.join(temp_dir, "target.tar"), path)
+        # Generate a new shifted tarball, compressing it on the fly.  The
+        # source tarball is uncompressed as it gets read, front to back.
+        logger.debug("Opening tarball for processing")
+        with tarfile.open(rootfs_path, "r|gz") as source_tarball, \
+                tools.xz_compress_stream(path) as compressed:
+            target_tarball = tarfile.open(fileobj=compressed, mode="w|",
+                                          format=tarfile.GNU_FORMAT)
+
+            for entry in source_tarball:
+                # FIXME: Will need to be done on the real rootfs
+                # Skip some files
+                if entry.name in ("SWAP.swap", "etc/mtab"):
+                    continue
+
+                fileptr = None
+                if entry.isfile():
+                    fileptr = source_tarball.extractfile(entry)
+
+                # Update hardlinks to point to the right target
+                if entry.islnk():
+                    entry.linkname = f"system/{entry.linkname}"
+
+                entry.name = f"system/{entry.name}"
+                target_tarball.addfile(entry, fileobj=fileptr)
+
+                # TarFile keeps every member it reads, even in stream mode.
+                # Nothing looks back at them, so don't let them pile up.
+                source_tarball.members = []
+
+            now = int(time.time())
+
+            # The touch and pocket-desktop products are the same.
+            if options.get("product", "touch") in ("touch", "pd"):
+                # FIXME: Will need to be done on the real rootfs
+                # Add some symlinks and directories
+                # # /android, Android partitions and /vendor
+                for name, member_type, mode, linkname in ANDROID_ENTRIES:
+                    target_tarball.addfile(make_tarinfo(
+                        name, member_type, mode, now, linkname))
+
+            # writable partition
+            # (/userdata for Touch, /writable for Core)
+            if options.get("product", "touch") == "core":
+                writable_path = "system/writable"
+            else:
+                writable_path = "system/userdata"
+            target_tarball.addfile(make_tarinfo(
+                writable_path, tarfile.DIRTYPE, 0o755, now))
+
+            # # /etc/mtab and /lib/modules
+            for name, member_type, mode, linkname in ROOTFS_ENTRIES:
+                target_tarball.addfile(make_tarinfo(
+                    name, member_type, mode, now, linkname))
+
+            logger.debug("Closing tarball")
+            target_tarball.close()
+
+        # Sign the target tarball
         gpg.sign_file(conf, "image-signing", path)
 
         # Generate the metadata file
@@ -685,13 +687,7 @@ def generate_file_cdimage_ubuntu(conf, arguments, environment):
         metadata['rootfs_path'] = rootfs_path
         metadata['rootfs_checksum'] = rootfs_hash
 
-        with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-            fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                         indent=4, separators=(",", ": ")))
-        gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
-
-        # Cleanup
-        shutil.rmtree(temp_dir)
+        write_metadata(conf, path, metadata)
 
         environment['version_detail'].append(version_detail)
         return path
@@ -717,13 +713,7 @@ def generate_file_cdimage_custom(conf, arguments, environment):
     if len(arguments) > 2:
         options = unpack_arguments(arguments[2])
 
-    arch = "armhf"
-    if environment['device_name'] in ("generic_x86", "generic_i386"):
-        arch = "i386"
-    elif environment['device_name'] in ("generic_amd64",):
-        arch = "amd64"
-    elif environment['device_name'] in ("generic_arm64", "frieza_arm64"):
-        arch = "arm64"
+    arch = CUSTOM_ARCHES.get(environment['device_name'], "armhf")
 
     # Check that the directory exists
     if not os.path.exists(cdimage_path):
@@ -757,14 +747,9 @@ def generate_file_cdimage_custom(conf, arguments, environment):
         version_detail = "custom=%s" % version
 
         # Extract the hash
-        custom_hash = None
-        with open(os.path.join(cdimage_path, version,
-                               "SHA256SUMS"), "r") as fd:
-            for line in fd:
-                line = line.strip()
-                if line.endswith(custom_path.split("/")[-1]):
-                    custom_hash = line.split()[0]
-                    break
+        checksums = read_sha256sums(os.path.join(cdimage_path, version,
+                                                 "SHA256SUMS"))
+        custom_hash = checksums.get(os.path.basename(custom_path))
 
         if not custom_hash:
             continue
@@ -776,29 +761,15 @@ def generate_file_cdimage_custom(conf, arguments, environment):
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return path
-
-        temp_dir = tempfile.mkdtemp()
-
-        # Unpack the source tarball
-        tools.gzip_uncompress(custom_path, os.path.join(temp_dir,
-                                                        "source.tar"))
+            return reuse_pool_file(path, version_detail, environment)
 
         # Create the pool if it doesn't exist
-        if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-            os.makedirs(os.path.join(conf.publish_path, "pool"))
+        os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
-        # Compress the target tarball and sign it
-        tools.xz_compress(os.path.join(temp_dir, "source.tar"), path)
+        # Recompress the source tarball straight into the pool and sign it
+        with gzip.open(custom_path, "rb") as source, \
+                tools.xz_compress_stream(path) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
         gpg.sign_file(conf, "image-signing", path)
 
         # Generate the metadata file
@@ -810,13 +781,7 @@ def generate_file_cdimage_custom(conf, arguments, environment):
         metadata['custom_path'] = custom_path
         metadata['custom_checksum'] = custom_hash
 
-        with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-            fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                         indent=4, separators=(",", ": ")))
-        gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
-
-        # Cleanup
-        shutil.rmtree(temp_dir)
+        write_metadata(conf, path, metadata)
 
         environment['version_detail'].append(version_detail)
         return path
@@ -842,19 +807,7 @@ def generate_file_cdimage_device_raw(conf, arguments, environment):
     if len(arguments) > 2:
         options = unpack_arguments(arguments[2])
 
-    arch = "armhf"
-    if environment['device_name'] in ("generic_x86", "generic_i386"):
-        arch = "i386"
-    elif environment['device_name'] in ("generic_amd64",):
-        arch = "amd64"
-    elif environment['device_name'] == "azure_amd64":
-        arch = "amd64.azure"
-    elif environment['device_name'] == "plano":
-        arch = "amd64.plano"
-    elif environment['device_name'] == "raspi2_armhf":
-        arch = "armhf.raspi2"
-    elif environment['device_name'] == "generic_arm64":
-        arch = "arm64"
+    arch = DEVICE_RAW_ARCHES.get(environment['device_name'], "armhf")
 
     # Check that the directory exists
     if not os.path.exists(cdimage_path):
@@ -886,14 +839,9 @@ def generate_file_cdimage_device_raw(conf, arguments, environment):
         version_detail = "raw-device=%s" % version
 
         # Extract the hash
-        raw_device_hash = None
-        with open(os.path.join(cdimage_path, version,
-                               "SHA256SUMS"), "r") as fd:
-            for line in fd:
-                line = line.strip()
-                if line.endswith(raw_device_path.split("/")[-1]):
-                    raw_device_hash = line.split()[0]
-                    break
+        checksums = read_sha256sums(os.path.join(cdimage_path, version,
+                                                 "SHA256SUMS"))
+        raw_device_hash = checksums.get(os.path.basename(raw_device_path))
 
         if not raw_device_hash:
             continue
@@ -905,29 +853,15 @@ def generate_file_cdimage_device_raw(conf, arguments, environment):
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return path
-
-        temp_dir = tempfile.mkdtemp()
-
-        # Unpack the source tarball
-        tools.gzip_uncompress(raw_device_path, os.path.join(temp_dir,
-                                                            "source.tar"))
+            return reuse_pool_file(path, version_detail, environment)
 
         # Create the pool if it doesn't exist
-        if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-            os.makedirs(os.path.join(conf.publish_path, "pool"))
+        os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
-        # Compress the target tarball and sign it
-        tools.xz_compress(os.path.join(temp_dir, "source.tar"), path)
+        # Recompress the source tarball straight into the pool and sign it
+        with gzip.open(raw_device_path, "rb") as source, \
+                tools.xz_compress_stream(path) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
         gpg.sign_file(conf, "image-signing", path)
 
         # Generate the metadata file
@@ -940,13 +874,7 @@ def generate_file_cdimage_device_raw(conf, arguments, environment):
         metadata['raw_device_checksum'] = raw_device_hash
         metadata['device'] = environment.get("device_name", "none")
 
-        with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-            fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                         indent=4, separators=(",", ": ")))
-        gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
-
-        # Cleanup
-        shutil.rmtree(temp_dir)
+        write_metadata(conf, path, metadata)
 
         environment['version_detail'].append(version_detail)
         return path
@@ -992,48 +920,26 @@ def generate_file_http(conf, arguments, environment):
         version_detail = "%s=%s" % (options.get("name", "http"), version)
 
         # FIXME: can be dropped once all the non-hased tarballs are gone
-        old_path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                                 "%s-%s.tar.xz" %
-                                                 (options.get("name", "http"),
-                                                  version)))
+        old_path = pool_path(conf, "%s-%s.tar.xz" %
+                             (options.get("name", "http"), version))
         logger.debug("Path generated: %s" % old_path)
 
         if os.path.exists(old_path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(old_path.replace(".tar.xz", ".json")):
-                with open(old_path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return old_path
+            return reuse_pool_file(old_path, version_detail, environment)
 
         # Build the path, hasing together the URL and version
         hash_string = "%s:%s" % (url, version)
         global_hash = sha256(hash_string.encode("utf-8")).hexdigest()
-        path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                             "%s-%s.tar.xz" %
-                                             (options.get("name", "http"),
-                                              global_hash)))
+        path = pool_path(conf, "%s-%s.tar.xz" %
+                         (options.get("name", "http"), global_hash))
         logger.debug("Path generated: %s" % path)
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
-            return path
+            return reuse_pool_file(path, version_detail, environment)
 
     # Grab the real thing
-    tempdir = tempfile.mkdtemp()
+    tempdir = make_temp_dir(conf)
     old_timeout = socket.getdefaulttimeout()
     socket.setdefaulttimeout(5)
     try:
@@ -1050,7 +956,7 @@ def generate_file_http(conf, arguments, environment):
     if not version:
         # Hash the file
         with open(os.path.join(tempdir, "download"), "rb") as fd:
-            version = sha256(fd.read()).hexdigest()
+            version = file_digest(fd, "sha256").hexdigest()
 
         # Set version_detail
         version_detail = "%s=%s" % (options.get("name", "http"), version)
@@ -1059,29 +965,17 @@ def generate_file_http(conf, arguments, environment):
         CACHE['http_%s' % url] = version
 
         # Build the path
-        path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                             "%s-%s.tar.xz" %
-                                             (options.get("name", "http"),
-                                              version)))
+        path = pool_path(conf, "%s-%s.tar.xz" %
+                         (options.get("name", "http"), version))
         logger.debug("Path generated: %s" % path)
 
         # Return pre-existing entries
         if os.path.exists(path):
-            # Get the real version number (in case it got copied)
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    version_detail = metadata['version_detail']
-
-            environment['version_detail'].append(version_detail)
             shutil.rmtree(tempdir)
-            return path
+            return reuse_pool_file(path, version_detail, environment)
 
     # Create the pool if it doesn't exist
-    if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-        os.makedirs(os.path.join(conf.publish_path, "pool"))
+    os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
     # Move the file to the pool and sign it
     shutil.move(os.path.join(tempdir, "download"), path)
@@ -1094,10 +988,7 @@ def generate_file_http(conf, arguments, environment):
     metadata['version_detail'] = version_detail
     metadata['url'] = url
 
-    with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-        fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                     indent=4, separators=(",", ": ")))
-    gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
+    write_metadata(conf, path, metadata)
 
     # Cleanup
     shutil.rmtree(tempdir)
@@ -1131,18 +1022,16 @@ def generate_file_keyring(conf, arguments, environment):
         return None
 
     with open("%s.tar.xz" % keyring_path, "rb") as fd:
-        hash_tarball = sha256(fd.read()).hexdigest()
+        hash_tarball = file_digest(fd, "sha256").hexdigest()
 
     with open("%s.tar.xz.asc" % keyring_path, "rb") as fd:
-        hash_signature = sha256(fd.read()).hexdigest()
+        hash_signature = file_digest(fd, "sha256").hexdigest()
 
     hash_string = "%s/%s" % (hash_tarball, hash_signature)
     global_hash = sha256(hash_string.encode("utf-8")).hexdigest()
 
     # Build the path
-    path = os.path.realpath(os.path.join(conf.publish_path, "pool",
-                                         "keyring-%s.tar.xz" %
-                                         global_hash))
+    path = pool_path(conf, "keyring-%s.tar.xz" % global_hash)
     logger.debug("Path generated: %s" % path)
 
     # Set the version_detail string
@@ -1153,7 +1042,7 @@ def generate_file_keyring(conf, arguments, environment):
         return path
 
     # Create temporary directory
-    tempdir = tempfile.mkdtemp()
+    tempdir = make_temp_dir(conf)
 
     # Generate the tarball
     tarball = tarfile.open(os.path.join(tempdir, "output.tar"), "w:",
@@ -1169,8 +1058,7 @@ def generate_file_keyring(conf, arguments, environment):
     tarball.close()
 
     # Create the pool if it doesn't exist
-    if not os.path.exists(os.path.join(conf.publish_path, "pool")):
-        os.makedirs(os.path.join(conf.publish_path, "pool"))
+    os.makedirs(os.path.join(conf.publish_path, "pool"), exist_ok=True)
 
     # Compress and sign it
     tools.xz_compress(os.path.join(tempdir, "output.tar"), path)
@@ -1183,10 +1071,7 @@ def generate_file_keyring(conf, arguments, environment):
     metadata['version_detail'] = "keyring=%s" % keyring_name
     metadata['path'] = keyring_path
 
-    with open(path.replace(".tar.xz", ".json"), "w+") as fd:
-        fd.write("%s\n" % json.dumps(metadata, sort_keys=True,
-                                     indent=4, separators=(",", ": ")))
-    gpg.sign_file(conf, "image-signing", path.replace(".tar.xz", ".json"))
+    write_metadata(conf, path, metadata)
 
     # Cleanup
     shutil.rmtree(tempdir)
@@ -1275,7 +1160,7 @@ def generate_file_remote_system_image(conf, arguments, environment):
 
     # Found an image, so let's try to find a match
     for file_entry in full_images[-1]['files']:
-        file_name = file_entry['path'].split("/")[-1]
+        file_name = os.path.basename(file_entry['path'])
         file_prefix = file_name.rsplit("-", 1)[0]
         if file_prefix == prefix:
             path = os.path.realpath("%s/%s" % (conf.publish_path,
@@ -1286,8 +1171,7 @@ def generate_file_remote_system_image(conf, arguments, environment):
                 return path
 
             # Create the target if needed
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
             # Grab the file
             file_url = "%s/%s" % (base_url, file_entry['path'])
@@ -1366,12 +1250,12 @@ def generate_file_system_image(conf, arguments, environment):
 
     # Run some checks
     pub = tree.Tree(conf)
-    if channel_name not in pub.list_channels():
+    channels = pub.list_channels()
+    if channel_name not in channels:
         logger.error("Channel not in the published list: %s", channel_name)
         return None
 
-    if (device_name not in
-            pub.list_channels()[channel_name]['devices']):
+    if device_name not in channels[channel_name]['devices']:
         logger.error("Device not in the channel list: %s", device_name)
         return None
 
@@ -1390,20 +1274,17 @@ def generate_file_system_image(conf, arguments, environment):
 
     # Found an image, so let's try to find a match
     for file_entry in full_images[-1]['files']:
-        file_name = file_entry['path'].split("/")[-1]
+        file_name = os.path.basename(file_entry['path'])
         file_prefix = file_name.rsplit("-", 1)[0]
         if file_prefix == prefix:
             path = os.path.realpath("%s/%s" % (conf.publish_path,
                                                file_entry['path']))
             logger.debug("Path generated: %s", path)
 
-            if os.path.exists(path.replace(".tar.xz", ".json")):
-                with open(path.replace(".tar.xz", ".json"), "r") as fd:
-                    metadata = json.loads(fd.read())
-
-                if "version_detail" in metadata:
-                    environment['version_detail'].append(
-                        metadata['version_detail'])
+            metadata = read_metadata(path.replace(".tar.xz", ".json"))
+            if "version_detail" in metadata:
+                environment['version_detail'].append(
+                    metadata['version_detail'])
 
             return path
 
@@ -1439,7 +1320,7 @@ def generate_file_version(conf, arguments, environment):
     version_detail = ",".join(environment['version_detail'])
 
     # Create temporary directory
-    tempdir = tempfile.mkdtemp()
+    tempdir = make_temp_dir(conf)
 
     # Generate the tarball
     tools.generate_version_tarball(
@@ -1448,8 +1329,7 @@ def generate_file_version(conf, arguments, environment):
         os.path.join(tempdir, "version"), version_detail=version_detail)
 
     # Create the pool if it doesn't exist
-    if not os.path.exists(os.path.join(environment['device'].path)):
-        os.makedirs(os.path.join(environment['device'].path))
+    os.makedirs(environment['device'].path, exist_ok=True)
 
     # Compress and sign it
     tools.xz_compress(os.path.join(tempdir, "version"), path)
@@ -1468,3 +1348,18 @@ def generate_file_version(conf, arguments, environment):
     shutil.rmtree(tempdir)
 
     return path
+
+
+# Map of generator names (as used in the channel configuration) to their
+# implementation, used by generate_file().
+GENERATORS = {
+    "version": generate_file_version,
+    "cdimage-ubuntu": generate_file_cdimage_ubuntu,
+    "cdimage-custom": generate_file_cdimage_custom,
+    "cdimage-device-raw": generate_file_cdimage_device_raw,
+    "http": generate_file_http,
+    "http-cdimage": generate_file_http_livecd_rootfs,
+    "keyring": generate_file_keyring,
+    "system-image": generate_file_system_image,
+    "remote-system-image": generate_file_remote_system_image,
+}
@@ -14,13 +14,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __all__ = [
+    "READ_SIZE",
     "chdir",
+    "file_digest",
     ]
 
 
+import hashlib
 import os
 from contextlib import contextmanager
 
+READ_SIZE = 1024 * 1024
+
 
 @contextmanager
 def chdir(directory):
@@ -31,3 +36,27 @@ def chdir(directory):
         yield
     finally:
         os.chdir(old_dir)
+
+
+def file_digest(fileobj, digest):
+    """
+        Hash the content of a binary file object without reading it all
+        into memory.
+
+        digest is a hashlib algorithm name.
+        Returns the hash object.
+    """
+
+    if hasattr(hashlib, "file_digest"):  # pragma: no cover
+        return hashlib.file_digest(fileobj, digest)
+
+    hash_object = hashlib.new(digest)
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    while True:
+        size = fileobj.readinto(buf)
+        if not size:
+            break
+        hash_object.update(view[:size])
+
+    return hash_object
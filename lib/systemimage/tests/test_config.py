@@ -278,3 +278,117 @@ files = a
 
         self.assertRaises(KeyError, config.Config,
                           invalid_file_channel_config_path)
+
+    def test_parse_config_cache(self):
+        config_path = os.path.join(self.temp_directory, "config")
+        with open(config_path, "w+") as fd:
+            fd.write("[global]\nmirrors = a, b\n")
+
+        # Callers get their own copy of the cached content
+        parsed = config.parse_config(config_path)
+        parsed['global']['mirrors'].append("c")
+        self.assertEqual(config.parse_config(config_path),
+                         {'global': {'mirrors': ['a', 'b']}})
+
+        # Changes to the file are picked up
+        with open(config_path, "w+") as fd:
+            fd.write("[global]\nmirrors = a, b, c, d\n")
+        self.assertEqual(config.parse_config(config_path),
+                         {'global': {'mirrors': ['a', 'b', 'c', 'd']}})
+
+    def test_config_default_path_stat(self):
+        os.makedirs(os.path.join(self.temp_directory, "etc"))
+        with open(os.path.join(self.temp_directory, "etc", "config"),
+                  "w+") as fd:
+            fd.write("[global]\nbase_path = a/b\n")
+
+        # The default configuration file is only looked up once.
+        with system_image_root(self.temp_directory), \
+                mock.patch("os.stat", wraps=os.stat) as mock_stat:
+            conf = config.Config()
+        self.assertEqual(conf.base_path, "a/b")
+        self.assertEqual(mock_stat.call_count, 1)
+
+    def test_config_parsed(self):
+        parsed = {'global': {'base_path': self.temp_directory,
+                             'channels': "a"},
+                  'channel_a': {'fullcount': "5"}}
+
+        conf = config.Config(config=parsed)
+        self.assertEqual(conf.base_path, self.temp_directory)
+        self.assertEqual(conf.channels['a'].fullcount, 5)
+
+        # The parsed configuration is left untouched
+        self.assertEqual(parsed['global']['channels'], "a")
+
+        self.assertRaises(KeyError, config.Config,
+                          config={'global': {'channels': "a"}})
+
+    def test_get_config(self):
+        config_path = os.path.join(self.temp_directory, "config")
+        with open(config_path, "w+") as fd:
+            fd.write("[global]\nbase_path = a/b\n")
+
+        conf = config.get_config(config_path)
+        self.assertEqual(conf.base_path, "a/b")
+
+        # The file isn't read again until it changes.
+        with mock.patch("systemimage.config.read_config") as mock_read:
+            self.assertEqual(config.get_config(config_path).base_path, "a/b")
+        self.assertEqual(mock_read.call_count, 0)
+
+        with open(config_path, "w+") as fd:
+            fd.write("[global]\nbase_path = c/d/e\n")
+        self.assertEqual(config.get_config(config_path).base_path, "c/d/e")
+
+        self.assertRaises(Exception, config.get_config,
+                          os.path.join(self.temp_directory, "missing"))
+
+    def test_config_paths(self):
+        conf = config.Config(config={'global': {'base_path': "a/b",
+                                                'state_path': "/state"}})
+        self.assertEqual(conf.gpg_key_path, "a/b/secret/gpg/keys")
+        self.assertEqual(conf.gpg_keyring_path, "a/b/secret/gpg/keyrings")
+        self.assertEqual(conf.publish_path, "a/b/www")
+        self.assertEqual(conf.state_path, "/state")
+        self.assertIsNone(conf.temp_path)
+
+        conf = config.Config(config={'global': {'base_path': "a/b",
+                                                'temp_path': "tmp"}})
+        self.assertEqual(conf.temp_path, "a/b/tmp")
+
+    def test_parse_config_syntax(self):
+        config_path = os.path.join(self.temp_directory, "config")
+        with open(config_path, "w+") as fd:
+            fd.write("""# Comment
+[DEFAULT]
+shared = value
+
+[global]
+; Other comment
+a = 1
+b: 2
+c = multi
+    line
+
+    value
+d = "quoted", list
+e = generator;arg,option=value
+shared = override
+
+[other]
+""")
+
+        self.assertEqual(config.parse_config(config_path),
+                         {'global': {'a': "1", 'b': "2",
+                                     'c': "multi\nline\n\nvalue",
+                                     'd': ["quoted", "list"],
+                                     'e': "generator;arg,option=value",
+                                     'shared': "override"},
+                          'other': {'shared': "value"}})
+
+        # Duplicate entries
+        for content in ("[a]\n[a]\n", "[a]\nb = 1\nb = 2\n", "[a]\nb\n"):
+            with open(config_path, "w+") as fd:
+                fd.write(content)
+            self.assertEqual(config.parse_config(config_path), {})
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import pickle
 import shutil
 import sys
 import tarfile
@@ -23,7 +24,9 @@ import tempfile
 import unittest
 from io import BytesIO, StringIO
 
-from systemimage.diff import ImageDiff, compare_files
+from systemimage.diff import (PARALLEL_COMPARE_MIN, ImageDiff, compare_files,
+                              prune_scan_cache)
+from systemimage.helpers import READ_SIZE
 
 
 class DiffTests(unittest.TestCase):
@@ -211,12 +214,13 @@ class DiffTests(unittest.TestCase):
         self.target_tarball_path = target_tarball_path
 
     def test_content(self):
-        content_set, content_dict = self.imagediff.scan_content("source")
+        content_dict = self.imagediff.scan_content("source")
         self.assertEqual(sorted(content_dict.keys()),
                          ['a', 'b', 'c', 'c/d', 'c/g', 'c/h', 'dir', 'm',
                           'n', 'system/中文中文中文'])
+        self.assertEqual(self.imagediff.source_hardlinks, {'c/h', 'n'})
 
-        content_set, content_dict = self.imagediff.scan_content("target")
+        content_dict = self.imagediff.scan_content("target")
         self.assertEqual(sorted(content_dict.keys()),
                          ['a', 'c', 'c/a_i', 'c/c', 'c/d', 'c/g', 'c/h',
                           'c/j', 'dir', 'e', 'f', 'm', 'n', 'system/o',
@@ -225,14 +229,155 @@ class DiffTests(unittest.TestCase):
     def test_content_invalid_image(self):
         self.assertRaises(KeyError, self.imagediff.scan_content, "invalid")
 
+    def test_index_members(self):
+        members = self.imagediff.index_members("source")
+        self.assertEqual(sorted(members.keys()),
+                         ['a', 'b', 'c', 'c/d', 'c/g', 'c/h', 'dir', 'm',
+                          'n', 'system/中文中文中文'])
+        self.assertIs(members['a'], self.imagediff.source_file.getmember("a"))
+        self.assertIs(self.imagediff.index_members("source"), members)
+
+        self.assertRaises(KeyError, self.imagediff.index_members, "invalid")
+
+    def test_content_cache(self):
+        cache_path = os.path.join(self.temp_directory, "cache")
+        imagediff = ImageDiff(self.source_tarball_path,
+                              self.target_tarball_path, cache_path=cache_path)
+        content = imagediff.scan_content("source")
+        self.assertEqual(len(os.listdir(cache_path)), 1)
+
+        # A valid cache entry is used instead of the image.
+        cache_file = imagediff.scan_cache_file(self.source_tarball_path)
+        with open(cache_file, "wb") as fd:
+            pickle.dump(({"cached": None}, set(), None), fd)
+
+        imagediff = ImageDiff(self.source_tarball_path,
+                              self.target_tarball_path, cache_path=cache_path)
+        self.assertEqual(imagediff.scan_content("source"), {"cached": None})
+
+        # Corrupt entries are rescanned and replaced.
+        for data in (b"", b"garbage", pickle.dumps(({}, set()))):
+            with open(cache_file, "wb") as fd:
+                fd.write(data)
+
+            imagediff = ImageDiff(self.source_tarball_path,
+                                  self.target_tarball_path,
+                                  cache_path=cache_path)
+            self.assertEqual(imagediff.scan_content("source"), content)
+            with open(cache_file, "rb") as fd:
+                self.assertEqual(pickle.load(fd)[0], content)
+
+        # Changing the image invalidates its entry.
+        os.utime(self.source_tarball_path, ns=(0, 0))
+        imagediff = ImageDiff(self.source_tarball_path,
+                              self.target_tarball_path, cache_path=cache_path)
+        self.assertEqual(imagediff.scan_content("source"), content)
+
+        # The origin of the image can be used as the key instead.
+        origin = os.path.join(self.temp_directory, "source.tar.xz")
+        open(origin, "w+").close()
+        imagediff = ImageDiff(self.source_tarball_path,
+                              self.target_tarball_path, cache_path=cache_path,
+                              source_origin=origin)
+        imagediff.scan_content("source")
+        self.assertTrue(os.path.exists(imagediff.scan_cache_file(origin)))
+
+        full_member = imagediff.index_members("source")["a"]
+
+        # The member index is cached too, so the image doesn't get walked.
+        imagediff = ImageDiff(self.source_tarball_path,
+                              self.target_tarball_path, cache_path=cache_path,
+                              source_origin=origin)
+        imagediff.scan_content("source")
+        self.assertEqual(sorted(imagediff.index_members("source")),
+                         sorted(content))
+        member = imagediff.index_members("source")["a"]
+        self.assertEqual(imagediff.source_file.extractfile(member).read(),
+                         b"test")
+
+        # The complete member can be read back from its header.
+        self.assertEqual(
+            imagediff.read_member("source", member).get_info(),
+            full_member.get_info())
+
+        # Only the first member is read when opening the image.
+        self.assertEqual(len(imagediff.source_file.members), 1)
+
+        # Reading a header doesn't get in the way of walking the image.
+        with tarfile.open(self.source_tarball_path) as source_tarball:
+            self.assertEqual(
+                [entry.name for entry in imagediff.source_file],
+                source_tarball.getnames())
+
+    def test_prune_scan_cache(self):
+        cache_path = os.path.join(self.temp_directory, "cache")
+
+        # A missing cache is fine.
+        prune_scan_cache(cache_path)
+
+        os.mkdir(cache_path)
+        for index, name in enumerate(("a.pickle", "b.pickle", "c.pickle",
+                                      "c.pickle.1.2")):
+            with open(os.path.join(cache_path, name), "wb") as fd:
+                fd.write(b"x" * 10)
+            os.utime(os.path.join(cache_path, name), (index, index))
+
+        # The least recently used entries go first, temporary files stay.
+        prune_scan_cache(cache_path, 20)
+        self.assertEqual(sorted(os.listdir(cache_path)),
+                         ["b.pickle", "c.pickle", "c.pickle.1.2"])
+
+        prune_scan_cache(cache_path, 0)
+        self.assertEqual(os.listdir(cache_path), ["c.pickle.1.2"])
+
     def test_compare_files(self):
         self.assertEqual(compare_files(None, None), True)
         self.assertEqual(compare_files(None, BytesIO(b"abc")), False)
+        self.assertEqual(
+            compare_files(BytesIO(b"abc"), BytesIO(b"abc")), True)
+        self.assertEqual(
+            compare_files(BytesIO(b"abc"), BytesIO(b"abd")), False)
+
+        # Content spanning several blocks.
+        content = b"a" * READ_SIZE * 2
+        self.assertEqual(
+            compare_files(BytesIO(content), BytesIO(content)), True)
+        self.assertEqual(
+            compare_files(BytesIO(content), BytesIO(content + b"b")), False)
+        self.assertEqual(
+            compare_files(BytesIO(content + b"b"), BytesIO(content)), False)
+
+        with tarfile.open(self.source_tarball_path, "r") as source, \
+                tarfile.open(self.target_tarball_path, "r") as target:
+            self.assertEqual(compare_files(source.extractfile("a"),
+                                           target.extractfile("a")), True)
+            self.assertEqual(compare_files(source.extractfile("c/d"),
+                                           target.extractfile("c/d")), False)
 
     def test_compare_image(self):
         diff_set = self.imagediff.compare_images()
         self.assertTrue(("c/a_i", "add") in diff_set)
 
+    def test_compare_image_symlink_mtime(self):
+        source_path = os.path.join(self.temp_directory, "source-link.tar")
+        target_path = os.path.join(self.temp_directory, "target-link.tar")
+
+        for path, mtime, moved_linkname in ((source_path, 1000, "a"),
+                                            (target_path, 1001, "b")):
+            with tarfile.open(path, "w", encoding="utf-8") as tarball:
+                for name, linkname in (("same", "a"),
+                                       ("moved", moved_linkname)):
+                    entry = tarfile.TarInfo()
+                    entry.name = name
+                    entry.type = tarfile.SYMTYPE
+                    entry.mtime = mtime
+                    entry.linkname = linkname
+                    tarball.addfile(entry)
+
+        # Symlinks only differing in mtime are unchanged.
+        imagediff = ImageDiff(source_path, target_path)
+        self.assertEqual(imagediff.compare_images(), {("moved", "mod")})
+
     def test_print_changes(self):
         # Redirect stdout
         old_stdout = sys.stdout
@@ -291,6 +436,32 @@ dir
 system/中文中文中文
 """)
 
+    def test_generate_tarball_cached(self):
+        cache_path = os.path.join(self.temp_directory, "cache")
+        outputs = []
+        for index in range(3):
+            imagediff = ImageDiff(self.source_tarball_path,
+                                  self.target_tarball_path,
+                                  cache_path=cache_path)
+            output_tarball = "%s/output-%s.tar" % (self.temp_directory,
+                                                   index)
+            imagediff.generate_diff_tarball(output_tarball)
+
+            with tarfile.open(output_tarball, "r") as tarball:
+                outputs.append([
+                    (entry.get_info(),
+                     tarball.extractfile(entry).read()
+                     if entry.isfile() else None)
+                    for entry in tarball if entry.name != "removed"])
+
+        # Once the scans are cached, neither image gets walked...
+        self.assertEqual(len(imagediff.source_file.members), 1)
+        self.assertEqual(len(imagediff.target_file.members), 1)
+
+        # ... and the result stays the same.
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
 
 class TestHardLinkTargetIsModified(unittest.TestCase):
     def setUp(self):
@@ -432,3 +603,92 @@ class TestHardLinkTargetIsModified(unittest.TestCase):
         with open(os.path.join(unpack_path, "b"), "rb") as fp:
             contents = fp.read()
         self.assertEqual(contents, b"YYYYY")
+
+
+class TestParallelCompare(unittest.TestCase):
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_directory)
+
+        self.source_path = os.path.join(self.temp_directory, "source.tar")
+        self.target_path = os.path.join(self.temp_directory, "target.tar")
+
+        with tarfile.open(self.source_path, "w", encoding="utf-8") as \
+                source_tarball, \
+                tarfile.open(self.target_path, "w", encoding="utf-8") as \
+                target_tarball:
+            # Enough files only differing in mtime to use the thread pool,
+            # with every other one also differing in content.
+            for index in range(PARALLEL_COMPARE_MIN * 2):
+                entry = tarfile.TarInfo()
+                entry.name = "file-%s" % index
+                entry.size = 4
+                entry.mtime = 1000
+                source_tarball.addfile(entry, BytesIO(b"test"))
+
+                entry.mtime = 1001
+                content = b"test" if index % 2 else b"TEST"
+                target_tarball.addfile(entry, BytesIO(content))
+
+                # A hardlink to each of the files.
+                link = tarfile.TarInfo()
+                link.name = "link-%s" % index
+                link.type = tarfile.LNKTYPE
+                link.linkname = entry.name
+                source_tarball.addfile(link)
+                target_tarball.addfile(link)
+
+    def test_compare_images(self):
+        diff = ImageDiff(self.source_path, self.target_path)
+        changes = diff.compare_images()
+
+        expected = set()
+        for index in range(0, PARALLEL_COMPARE_MIN * 2, 2):
+            expected.add(("file-%s" % index, "mod"))
+            expected.add(("link-%s" % index, "mod"))
+        self.assertEqual(changes, expected)
+
+    def test_resolve_member(self):
+        diff = ImageDiff(self.source_path, self.target_path)
+        members = diff.index_members("source")
+
+        self.assertEqual(diff.resolve_member(members, members["link-0"]),
+                         members["file-0"])
+        self.assertEqual(diff.resolve_member(members, members["file-0"]),
+                         members["file-0"])
+
+        # Links to missing members are left for tarfile to deal with.
+        members = dict(members)
+        del members["file-1"]
+        self.assertEqual(diff.resolve_member(members, members["link-1"]),
+                         members["link-1"])
+
+    def test_resolve_member_dot_prefix(self):
+        # Rootfs tarballs often have all their names starting with "./".
+        path = os.path.join(self.temp_directory, "dot.tar")
+        with tarfile.open(path, "w", encoding="utf-8") as tarball:
+            entry = tarfile.TarInfo()
+            entry.name = "./file"
+            entry.size = 4
+            tarball.addfile(entry, BytesIO(b"test"))
+
+            link = tarfile.TarInfo()
+            link.name = "./link"
+            link.type = tarfile.LNKTYPE
+            link.linkname = "./file"
+            tarball.addfile(link)
+
+        diff = ImageDiff(path, path)
+        members = diff.index_members("source")
+        self.assertEqual(diff.resolve_member(members, members["./link"]),
+                         members["./file"])
+
+    def test_shared_entries(self):
+        diff = ImageDiff(self.source_path, self.target_path)
+        diff.compare_images()
+
+        # Identical entries of both images are the same object.
+        self.assertIs(diff.source_content["link-0"],
+                      diff.target_content["link-0"])
+        self.assertIsNot(diff.source_content["file-0"],
+                         diff.target_content["file-0"])
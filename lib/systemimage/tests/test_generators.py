@@ -88,6 +88,50 @@ public_https_port = 8443
                          "a=1,b=2=1,c,v=1=1=1=1,d=c"),
                          {'a': "1", 'b': "2=1", "v": "1=1=1=1", "d": "c"})
 
+    @unittest.skipUnless(HAS_TEST_KEYS, MISSING_KEYS_WARNING)
+    def test_list_versions(self):
+        cdimage_tree = os.path.join(self.temp_directory, "cdimage")
+        os.mkdir(cdimage_tree)
+        for version in ("20200101", "20210101", "pending"):
+            os.mkdir(os.path.join(cdimage_tree, version))
+        os.symlink("20210101", os.path.join(cdimage_tree, "current"))
+        open(os.path.join(cdimage_tree, "README"), "w+").close()
+
+        self.assertEqual(generators.list_versions(cdimage_tree),
+                         ["20210101", "20200101"])
+
+    @unittest.skipUnless(HAS_TEST_KEYS, MISSING_KEYS_WARNING)
+    def test_read_sha256sums(self):
+        sums_path = os.path.join(self.temp_directory, "SHA256SUMS")
+        with open(sums_path, "w+") as fd:
+            fd.write("HASH1 *file-1.tar.gz\nHASH2  file 2.img\n\n")
+
+        self.assertEqual(generators.read_sha256sums(sums_path),
+                         {"file-1.tar.gz": "HASH1", "file 2.img": "HASH2"})
+
+        # Changes to the file are picked up
+        with open(sums_path, "w+") as fd:
+            fd.write("HASH3 *file-1.tar.gz\n")
+
+        self.assertEqual(generators.read_sha256sums(sums_path),
+                         {"file-1.tar.gz": "HASH3"})
+
+    @unittest.skipUnless(HAS_TEST_KEYS, MISSING_KEYS_WARNING)
+    def test_read_metadata(self):
+        json_path = os.path.join(self.temp_directory, "file-1.json")
+        self.assertEqual(generators.read_metadata(json_path), {})
+
+        with open(json_path, "w+") as fd:
+            fd.write(json.dumps({'version_detail': "abcd"}))
+        self.assertEqual(generators.read_metadata(json_path),
+                         {'version_detail': "abcd"})
+
+        # Changes to the file are picked up
+        with open(json_path, "w+") as fd:
+            fd.write(json.dumps({'version_detail': "abcdef"}))
+        self.assertEqual(generators.read_metadata(json_path),
+                         {'version_detail': "abcdef"})
+
     @unittest.skipUnless(HAS_TEST_KEYS, MISSING_KEYS_WARNING)
     def test_generate_delta(self):
         # Source tarball
@@ -545,6 +589,9 @@ public_https_port = 8443
             if url.endswith("long"):
                 return BytesIO(b"42\n42\n42")
 
+            if url.endswith("huge"):
+                return BytesIO(b"42" * 4096)
+
             return BytesIO(b"42")
         mock_urlopen.side_effect = urlopen_side_effect
 
@@ -615,6 +662,15 @@ public_https_port = 8443
                                      environment),
             None)
 
+        # Oversized build number with monitor
+        generators.CACHE = {}
+        self.assertEqual(
+            generators.generate_file(self.config, "http",
+                                     ["http://1.2.3.4/file",
+                                      "monitor=http://1.2.3.4/huge"],
+                                     environment),
+            None)
+
         # Normal run without monitor
         generators.CACHE = {}
         self.assertEqual(
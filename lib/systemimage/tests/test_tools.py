@@ -234,6 +234,30 @@ version_detail: abcdef
         self.assertRaises(Exception, tools.xz_uncompress, "%s.xz" % test_file)
         self.assertRaises(Exception, tools.xz_uncompress, test_file)
 
+    def test_xz_compress_stream(self):
+        test_string = b"test-string"
+
+        xz_file = os.path.join(self.temp_directory, "test.txt.xz")
+        with tools.xz_compress_stream(xz_file) as fd:
+            fd.write(test_string)
+
+        self.assertEqual(tools.xz_uncompress(xz_file), 0)
+        with open(xz_file[:-3], "rb") as fd:
+            self.assertEqual(fd.read(), test_string)
+
+        # The destination must not exist yet
+        with self.assertRaises(Exception):
+            with tools.xz_compress_stream(xz_file):
+                pass
+
+        # Nothing is left behind on failure
+        xz_file = os.path.join(self.temp_directory, "failed.txt.xz")
+        with self.assertRaises(KeyError):
+            with tools.xz_compress_stream(xz_file) as fd:
+                fd.write(test_string)
+                raise KeyError("failed")
+        self.assertFalse(os.path.exists(xz_file))
+
     # Imported from cdimage.osextras
     def test_find_on_path_missing_environment(self):
         os.environ.pop("PATH", None)
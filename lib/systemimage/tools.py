@@ -25,13 +25,12 @@ import subprocess
 import tarfile
 import tempfile
 import time
+from contextlib import contextmanager
 from io import BytesIO
 from operator import itemgetter
 
 from systemimage import gpg
-from systemimage.helpers import chdir
-
-READ_SIZE = 1024 * 1024
+from systemimage.helpers import READ_SIZE, chdir
 
 logger = logging.getLogger(__name__)
 
@@ -285,6 +284,43 @@ def xz_compress(path, destination=None, level=9):
     return retval
 
 
+@contextmanager
+def xz_compress_stream(destination, level=9):
+    """
+        Compress everything written to the returned file object using xz,
+        storing the result at destination.
+        This avoids going through an uncompressed file on disk.
+        The compress level is 9 by default but can be overridden.
+    """
+
+    if os.path.exists(destination):
+        raise Exception("Destination already exists: %s" % destination)
+
+    logger.debug("Xzipping stream: %s" % destination)
+
+    with open(destination, "wb+") as fd:
+        process = subprocess.Popen([
+            'xz', '--memlimit=70%', '--threads=0', '-z', '-%s' % level,
+            '-c'
+            ],
+            stdin=subprocess.PIPE, stdout=fd)
+
+    try:
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+
+        if process.wait():
+            raise Exception("Failed to compress: %s" % destination)
+    except BaseException:
+        # Don't leave a partial file behind.
+        process.kill()
+        process.wait()
+        os.remove(destination)
+        raise
+
+
 def xz_uncompress(path, destination=None):
     """
         Uncompress a file (path) using xz.
@@ -292,7 +328,8 @@ def xz_uncompress(path, destination=None):
         An alternate destination path may be provided.
     """
 
-    # NOTE: Once we can drop support for < 3.3, the new lzma module can be used
+    # NOTE: The lzma module isn't used here as it can only decompress on a
+    #       single thread, while recent xz versions use all of them.
 
     if not destination and path[-3:] != ".xz":
         raise Exception("Unspecified destination and path doesn't end"